@@ -0,0 +1,77 @@
+import numba
+import numpy as np
+
+@numba.njit(cache = True, inline = 'always')
+def get_bin_id(value, bins):
+
+    # Equivalent to np.digitize(value, bins, right = False) for sorted
+    # bins: the number of edges which are less than or equal to the value
+    # (NaN goes above the last edge). For a handful of edges, this
+    # branchless count is faster than a search.
+    if value != value:
+        return bins.shape[0]
+    bin_id = 0
+    for k in range(bins.shape[0]):
+        bin_id += value >= bins[k]
+    return bin_id
+
+@numba.njit(parallel = True, cache = True)
+def accumulate_counts_by_zone_and_bin(zones, zone_ids, has_zones,
+                                      data, data_mask,
+                                      bins, in_PA, has_PA,
+                                      landuse_codes, landuse_valid,
+                                      has_landuse,
+                                      counts, counts_PA, counts_landuse,
+                                      n_chunks):
+
+    # In a single pass over the pixels, each valid pixel (non-zero in
+    # data_mask) is binned and counted by (zone, bin), by (zone, bin) if
+    # it is in a protected area, and by (zone, land use category, bin).
+    #
+    # The zones array holds local zone numbers (0 to n_local_zones - 1),
+    # only for the zones in this tile, and zone_ids gives the zone (the
+    # first axis of the count arrays) of each local zone.
+    #
+    # The rows of the raster are split into chunks (one per thread). Each
+    # chunk is counted into its own local arrays (to avoid threads
+    # writing to the same location), which are summed at the end. These
+    # are only as large as the number of zones in the tile (not the total
+    # number of zones), so they are cheap to allocate for each tile.
+    n_rows, n_cols = data.shape
+    n_cats, n_bin_ids = counts_landuse.shape[1:]
+    n_local_zones = zone_ids.shape[0]
+    local_counts = np.zeros((n_chunks, n_local_zones, n_bin_ids),
+                            dtype = np.int64)
+    local_counts_PA = np.zeros((n_chunks, n_local_zones, n_bin_ids),
+                               dtype = np.int64)
+    local_counts_landuse = np.zeros((n_chunks, n_local_zones, n_cats,
+                                     n_bin_ids), dtype = np.int64)
+
+    for c in numba.prange(n_chunks):
+
+        row_start = (c * n_rows) // n_chunks
+        row_end = ((c + 1) * n_rows) // n_chunks
+        for row in range(row_start, row_end):
+            for col in range(n_cols):
+
+                if data_mask[row, col] == 0:
+                    continue
+
+                # Without zones, all pixels are in (local) zone 0.
+                local_zone = zones[row, col] if has_zones else 0
+                bin_id = get_bin_id(data[row, col], bins)
+
+                local_counts[c, local_zone, bin_id] += 1
+                if has_PA and in_PA[row, col]:
+                    local_counts_PA[c, local_zone, bin_id] += 1
+                if has_landuse and landuse_valid[row, col]:
+                    local_counts_landuse[c, local_zone,
+                                         landuse_codes[row, col], bin_id] += 1
+
+    # Merge the counts from each chunk into the counts for each zone.
+    for c in range(n_chunks):
+        for local_zone in range(n_local_zones):
+            zone = zone_ids[local_zone]
+            counts[zone] += local_counts[c, local_zone]
+            counts_PA[zone] += local_counts_PA[c, local_zone]
+            counts_landuse[zone] += local_counts_landuse[c, local_zone]
@@ -1,165 +1,191 @@
+import functools
+import hashlib
 import logging
+import os
 
 import geopandas as gpd
 import numpy as np
-import rasterio
 from rasterio.features import rasterize
-from rasterio.mask import mask as rasterio_mask
-from rasterio.windows import from_bounds
+from rasterio.warp import transform_bounds
+import shapely
 
+from utilities.handle_cache import CACHE_DIR, write_file_atomically
 from utilities.handle_vector_files import (
-        load_gpkg_filtered_by_list_as_gdf)
-
-def clip_raster_to_polygon_and_apply_PA_mask(
-        polygon, raster_src, PA_mask):
-
-    # Clip the raster by the polgyon.
-    data_clipped, transform_clipped = clip_raster_to_polygon(polygon,
-                                                             raster_src)
-    if PA_mask is not None:
-        # Apply the PA mask.
-        data_clipped_and_masked = \
-                apply_full_size_mask_to_clipped_raster(raster_src,
-                                                       data_clipped,
-                                               transform_clipped, PA_mask)
-    else:
-        data_clipped_and_masked = None
+        get_gpkg_layer_crs, load_gpkg_filtered_by_list_as_gdf)
+
+# Maximum total size of the cached protected area files (the least
+# recently used are deleted beyond this).
+PA_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+def rasterize_polygon_zones(polygon_geoms, polygon_zone_ids, out_shape,
+                            transform, out = None):
+
+    # Rasterize the polygons, so that each pixel has the zone ID of the
+    # polygon which contains its centre, or 0 if it is outside all of the
+    # polygons. If an output array is given, it is reused.
+    if out is None:
+        out = np.empty(out_shape, dtype = 'int32')
+    out.fill(0)
+    zone_ids = rasterize(
+                    [(geom, int(zone_id)) for geom, zone_id
+                     in zip(polygon_geoms, polygon_zone_ids)],
+                    out = out,
+                    transform = transform,
+                    all_touched = False,
+                )
 
-    return data_clipped, data_clipped_and_masked
+    return zone_ids
 
-def clip_raster_to_polygon(polygon, raster_src):
-    
-    # Get a geoJSON-like representation of the polygon geometry.
-    polygon_geom_json = [polygon.__geo_interface__]
-    
-    # Clip the raster with the polygon.
-    raster_data_clipped_to_poly, \
-    raster_transform_clipped_to_poly = rasterio_mask(raster_src,
-                                            polygon_geom_json,
-                                            crop = True,
-                                            filled = True)
-
-    # Drop band axis,  if single-band.
-    raster_data_clipped_to_poly = raster_data_clipped_to_poly[0]
-    
-    # Re-apply the nodata mask.
-    nodata = raster_src.nodata
-    raster_data_clipped_to_poly = np.ma.masked_equal(
-                                    raster_data_clipped_to_poly, nodata)
-    
-    return raster_data_clipped_to_poly, raster_transform_clipped_to_poly
+def rasterize_PA_mask(PA_geoms, out_shape, transform, out = None):
 
-def apply_full_size_mask_to_clipped_raster(raster_src_unclipped,
-                                           data_clipped, transform_clipped,
-                                           mask):
+    # Rasterize the protected areas (a list of geometries) to create a
+    # mask. If an output array is given, it is reused.
+    inside_value  = 1
+    outside_value = 0
+    if out is None:
+        out = np.empty(out_shape, dtype = 'uint8')
+    out.fill(outside_value)
 
-    # Get bounds of clipped raster
-    clipped_bounds = rasterio.transform.array_bounds(
-        data_clipped.shape[0], data_clipped.shape[1], transform_clipped)
-    
-    # Get the window of the original raster that corresponds to
-    # the clipped bounds.
-    clipping_window = from_bounds(*clipped_bounds,
-                              transform = raster_src_unclipped.transform)
-    
-    # Read the relevant portion of the full mask using the clipping window.
-    i0 = int(round(clipping_window.row_off))
-    i1 = int(round(clipping_window.row_off + clipping_window.height))
-    j0 = int(round(clipping_window.col_off))
-    j1 = int(round(clipping_window.col_off + clipping_window.width))
-    #
-    clipped_mask = mask[i0 : i1, j0 : j1]
+    # No protected areas intersect the raster.
+    if len(PA_geoms) == 0:
+        return out
 
-    # Apply the clipped mask to the clipped raster (taking into account
-    # any mask that the clipped raster already has).
-    data_masked = update_mask(data_clipped, clipped_mask == 0, np.logical_or)
+    mask_PAs = rasterize(
+                    [(geom, inside_value) for geom in PA_geoms],
+                    out = out,
+                    transform = transform,
+                )
 
-    return data_masked
+    return mask_PAs
 
 def load_protected_areas_for_raster_clipping(path_PA_gpkg,
-                        adm0_list, raster_crs,
-                        raster_shape, raster_transform):
+                        adm0_list, raster_crs, raster_bounds = None):
     
     logging.info('\n' + 80 * '-')
     logging.info('Preparing protected areas mask, to use in clipping')
+
+    # The dissolved and reprojected protected areas are cached (in memory
+    # and on disk) as WKB, so the arguments are converted to hashable
+    # types.
+    if raster_bounds is not None:
+        raster_bounds = tuple(raster_bounds)
+    PAs_wkb = load_protected_areas_as_wkb(path_PA_gpkg,
+                        tuple(sorted(adm0_list)), raster_crs.to_wkt(),
+                        raster_bounds)
+
+    # The geometry is returned (rather than a mask at the full size of
+    # the raster), and is only rasterized within the window that is
+    # needed.
+    PAs_MultiPolygon = shapely.from_wkb(PAs_wkb)
+
+    return PAs_MultiPolygon
+
+@functools.lru_cache(maxsize = 8)
+def load_protected_areas_as_wkb(path_PA_gpkg, adm0_tuple, raster_crs_wkt,
+                                raster_bounds):
+
+    # Check for a copy cached on disk by a previous run. The key includes
+    # the modification time and size of the protected areas file, so the
+    # cache is not used if the file changes.
+    file_stat = os.stat(path_PA_gpkg)
+    cache_key = hashlib.sha1(repr((os.path.abspath(path_PA_gpkg),
+                                   file_stat.st_mtime_ns, file_stat.st_size,
+                                   adm0_tuple, raster_crs_wkt,
+                                   raster_bounds)).encode()).hexdigest()
+    path_cache = os.path.join(CACHE_DIR, 'pa_{:}.wkb'.format(cache_key))
+    if os.path.exists(path_cache):
+
+        logging.info('Loading cached protected areas from {:}'.format(
+            path_cache))
+        with open(path_cache, 'rb') as in_id:
+            PAs_wkb = in_id.read()
+
+        # Update the modification time, which records when the cached file
+        # was last used.
+        os.utime(path_cache)
+
+        return PAs_wkb
+
+    # Transform the raster bounds into the CRS of the protected areas, so
+    # that only protected areas within the raster footprint are read.
+    if raster_bounds is not None:
+        PA_crs = get_gpkg_layer_crs(path_PA_gpkg)
+        bbox = transform_bounds(raster_crs_wkt, PA_crs, *raster_bounds)
+    else:
+        bbox = None
+
     # Load the protected areas (only for the countries that the raster
     # intersects).
     filter_field = 'iso3'
     gdf_PAs = load_gpkg_filtered_by_list_as_gdf(path_PA_gpkg,
-                            filter_field, adm0_list,
+                            filter_field, list(adm0_tuple),
                             additional_sql="MARINE IN (0, 1)", # Remove marine PAs.
+                            bbox = bbox,
                             )
     
     # Dissolve the protected areas into a single multipolygon.
     # This discards information about the protected areas, but should
     # make intersection calculations a bit faster.
-    PAs_dissolved_geom = gdf_PAs.union_all()
+    PAs_dissolved_geom = dissolve_PA_geometries(gdf_PAs)
 
     # Reproject the protected areas to match the raster projection.
     gdf_PAs = gpd.GeoDataFrame(geometry = [PAs_dissolved_geom],
                                crs = gdf_PAs.crs)
-    gdf_PAs = gdf_PAs.to_crs(raster_crs)
-    PAs_MultiPolygon = gdf_PAs.iloc[0].geometry
+    gdf_PAs = gdf_PAs.to_crs(raster_crs_wkt)
+    PAs_wkb = shapely.to_wkb(gdf_PAs.iloc[0].geometry)
 
-    # Rasterize the protected areas to create a mask.
-    inside_value  = 1
-    outside_value = 0
-    mask_PAs = rasterize(
-                    [(PAs_MultiPolygon, inside_value)],
-                    out_shape = raster_shape,
-                    transform = raster_transform,
-                    fill = outside_value,
-                    dtype = 'uint8'
-                )
+    # Save to the disk cache.
+    write_file_atomically(path_cache, PAs_wkb, mode = 'wb')
+    logging.info('Saved protected areas to cache {:}'.format(path_cache))
 
-    return mask_PAs
+    # Each raster (with its own bounds and projection) adds a file to the
+    # cache, so the cache is limited in size.
+    prune_PA_cache(PA_CACHE_MAX_BYTES)
 
-def prepare_PA_masked_raster_and_metadata(polygons_GDF, i, raster_data,
-                raster_src, PA_mask, landuse_src, polygon_id_field):
+    return PAs_wkb
 
-    # Case 1: A list of polygons has been provided.
-    if polygons_GDF is not None:
-        
-        # Unpack the name, geometry, and ISO code.
-        polygon = polygons_GDF.iloc[i]
-        #
-        polygon_name = polygon['name']
-        polygon_id = polygon[polygon_id_field]
-        polygon_geom = polygon['geometry']
-        #
+def prune_PA_cache(max_bytes):
 
-        # Use the polygon to clip the raster. Also, get a version
-        # that has secondary clipping by the protected areas.
-        raster_data, raster_data_masked =\
-                clip_raster_to_polygon_and_apply_PA_mask(
-                            polygon_geom, raster_src, PA_mask)
+    # Delete the least recently used cached protected area files, until
+    # the total size is within the limit.
+    with os.scandir(CACHE_DIR) as entries:
+        cache_files = [(entry.stat().st_mtime, entry.stat().st_size,
+                        entry.path) for entry in entries
+                       if entry.name.startswith('pa_') and
+                          entry.name.endswith('.wkb')]
+    cache_files.sort(reverse = True)
 
-        # Use the polygon to clip the landuse raster.
-        landuse_data, _ =\
-                clip_raster_to_polygon_and_apply_PA_mask(
-                            polygon_geom, landuse_src, PA_mask)
+    total_bytes = 0
+    for _, size, path_cache in cache_files:
 
+        total_bytes += size
+        if total_bytes > max_bytes:
 
+            logging.info('Removing old cached protected areas {:}'.format(
+                path_cache))
+            try:
+                os.remove(path_cache)
+            except FileNotFoundError:
+                # (Already removed by another process.)
+                pass
 
-    # Case 2: No list of polygons has been provided (do binning 
-    # for the whole raster, with no polygon clipping).
-    else:
+def dissolve_PA_geometries(gdf_PAs, chunk_size = 500):
 
-        #raster_data_i = raster_data
-        raster_data_masked = update_mask(raster_data, PA_mask == 0,
-                                           np.logical_or)
-        polygon_name = 'whole'
-        polygon_id = 'whole'
+    # The 'disjoint_subset' method (shapely >= 2.1) only unions geometries
+    # which actually touch, which is much faster for large sets of
+    # protected areas, most of which do not overlap. (The 'coverage'
+    # method is not used, because some protected areas do overlap.)
+    try:
 
-        landuse_data = landuse_src.read(1)
+        return gdf_PAs.union_all(method = 'disjoint_subset')
 
-    return (raster_data, raster_data_masked, polygon_name, polygon_id,
-            landuse_data)
+    except (TypeError, ValueError):
 
-def update_mask(array, new_mask, operator):
+        pass
 
-    new_mask = operator(array.mask, new_mask)
-    array_mask_updated= np.ma.masked_array(array.data,
-                                     mask = new_mask)
+    # Otherwise, do a chunked cascaded union.
+    geoms = gdf_PAs.geometry.values
+    chunk_unions = [shapely.union_all(geoms[i : i + chunk_size])
+                    for i in range(0, len(geoms), chunk_size)]
 
-    return array_mask_updated
+    return shapely.union_all(chunk_unions)
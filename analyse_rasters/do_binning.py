@@ -1,116 +1,169 @@
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import multiprocessing
+import os
+import tempfile
 
+import numba
 import numpy as np
 import rasterio
+from rasterio import windows
 from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.warp import transform_bounds
+import shapely
 
+from analyse_rasters.binning_kernels import (
+        accumulate_counts_by_zone_and_bin)
 from analyse_rasters.clipping_and_masking import (
         load_protected_areas_for_raster_clipping,
-        prepare_PA_masked_raster_and_metadata)
+        rasterize_PA_mask, rasterize_polygon_zones)
 from analyse_rasters.projection_tools import (
-        reproject_raster_wrapper, reproject_to_match)
+        open_warped_to_match, reproject_raster_wrapper)
 from analyse_rasters.raster_utils import (
-        calculate_pixel_size_and_counts,
-        make_in_memory_raster,
+        calculate_pixel_area_km2,
+        get_buffer_view,
+        iterate_raster_windows,
         )
 
+# Size (in pixels) of the square tiles which the raster is binned in.
+BINNING_TILE_SIZE = 2048
+
 def bin_raster_for_all_polygon_groups(path_raster, path_PA_gpkg,
     path_landuse, bins,
     dict_of_polygon_GDFs, adm0_list, polygon_id_field_dict,
     raster_band):
 
-    # Load the raster and re-project if necessary.
-    with rasterio.open(path_raster) as raster_src:
-
-        # Unpack raster information.
-        profile = raster_src.profile
-        crs = raster_src.crs
-        raster_data = raster_src.read(raster_band, masked = True)
-
-        # The raster must be in a projected coordinate system (coordinates
-        # with units of length, such as metres, as opposed to a geographic
-        # coordinate system with units of degrees), otherwise the grid cells
-        # will have different sizes, and cell counts will not be 
-        # proportional to area.
-        # So, if the raster does not already have a projected coordinate
-        # system, we must indentify a suitable one and re-project the
-        # raster.
-        if crs is None or crs.is_geographic:
-
-            # Reproject.
-            dst_profile, dst_crs, dst_raster_data, centroid = \
-                    reproject_raster_wrapper(raster_data, raster_src, profile)
-
-            # Overwrite values.
-            profile = dst_profile
-            crs = dst_crs
-            raster_data = dst_raster_data
-
-            # Replace raster_src with a new in-memory raster.
-            raster_src = make_in_memory_raster(raster_data, profile)
-
-    # Clip, reproject and align the land use raster.
-    # Use mode resampling for categorical data.
-    # This assumes the landuse raster has a geographical projection.
-    landuse_clip_buffer_degrees = 1.0
-    logging.info('Clipping, reprojecting and aligning landuse raster.')
-    landuse_data, landuse_profile = reproject_to_match(raster_src,
-                path_landuse,
-                resampling = Resampling.mode, 
-                buffer = landuse_clip_buffer_degrees)
-    landuse_src = make_in_memory_raster(landuse_data, landuse_profile)
-
-    #from plot_categorical_data import display_categorical_data 
-    #display_categorical_data(landuse_data, '../data/un_lcc_color_scheme.csv')
-
-    #import sys
-    #sys.exit()
-
-    ## Calculate the pixel size and pixel counts.
-    #(   pixel_width_metres, pixel_height_metres, pixel_area_km2,
-    #    n_pxls_total, n_pxls_masked, n_pxls_unmasked,
-    #    area_total_km2, area_masked_km2, area_unmasked_km2,
-    #    frac_pxls_masked, frac_pxls_unmasked) = \
-    #        calculate_pixel_size_and_counts(profile, raster_data)
-
-    # Load the protected areas for the countries which intersect the
-    # raster. The protected areas are dissolved into a single multipolygon
-    # geometry, and projected to match the raster CRS.
-    # !!! This could be made more efficient: Pre-process with a spatial
-    # join to assign each protected area with adm1 zone(s). Then we only
-    # need to load the PAs matching adm1.
-    PA_mask = load_protected_areas_for_raster_clipping(path_PA_gpkg,
-                        adm0_list, crs,
-                        (raster_src.height, raster_src.width),
-                        raster_src.transform)
-
-    # Do the binning.
-    #
-    # Give a warning if the bins do not encompass the full range of
-    # values in the raster.
-    #min_bin, max_bin = bins[0], bins[-1]
-    #if  ((raster_data.min() / scale_factor) < min_bin) or\
-    #    ((raster_data.max() / scale_factor) > max_bin):
-    #    warnings.warn("Some raster values fall outside the defined bins.")
-    # Prepare output dictionary.
-    results_for_all_polygon_groups__dict = dict()
-    # Loop over lists of polygons.
-    for polygons_name, polygons_GDF in dict_of_polygon_GDFs.items():
+    # Temporary directory for a re-projected copy of the raster.
+    with tempfile.TemporaryDirectory() as dir_tmp:
+
+        # Open the raster (to check its projection).
+        with rasterio.open(path_raster) as raster_src:
+
+            # Unpack raster information.
+            profile = raster_src.profile
+            crs = raster_src.crs
+
+            # The raster must be in a projected coordinate system (coordinates
+            # with units of length, such as metres, as opposed to a geographic
+            # coordinate system with units of degrees), otherwise the grid
+            # cells will have different sizes, and cell counts will not be 
+            # proportional to area.
+            # So, if the raster does not already have a projected coordinate
+            # system, we must indentify a suitable one and re-project the
+            # raster.
+            if crs is None or crs.is_geographic:
+
+                # Read the raster (the reprojection tools work on a masked
+                # array).
+                raster_data_masked = raster_src.read(raster_band, masked = True)
+
+                # Reproject.
+                dst_profile, dst_crs, dst_raster_data, centroid = \
+                        reproject_raster_wrapper(raster_data_masked,
+                                                 raster_src, profile)
+
+                # Overwrite values.
+                profile = dst_profile
+                crs = dst_crs
+
+                # Replace the raster with a (single-band) temporary file, so
+                # that it can be opened by the worker processes.
+                # The mask is written as well (as a mask band), because the
+                # masked pixels only hold the fill value, which is not the
+                # nodata value of the file (and there may be no nodata value).
+                # The workers then get the same mask from read_masks().
+                path_raster = os.path.join(dir_tmp, 'raster_reprojected.tif')
+                profile.update({'driver' : 'GTiff', 'count' : 1})
+                with rasterio.open(path_raster, 'w', **profile) as dst:
+                    dst.write(np.ma.getdata(dst_raster_data), 1)
+                    dst.write_mask(~np.ma.getmaskarray(dst_raster_data))
+                raster_band = 1
+
+        # Open the raster (or its reprojected copy) to find the land use
+        # categories and protected areas which cover it. The workers open
+        # it again to read it in tiles during the binning.
+        with rasterio.open(path_raster) as raster_src:
+
+            # Use mode resampling for categorical land use data.
+            # This assumes the landuse raster has a geographical projection.
+            # Find the land use categories in the region of the raster (these
+            # are shared by all of the polygon groups).
+            landuse_clip_buffer_degrees = 1.0
+            with rasterio.open(path_landuse) as landuse_src:
+                landuse_categories = find_landuse_categories(landuse_src,
+                                        raster_src, landuse_clip_buffer_degrees)
+
+            #from plot_categorical_data import display_categorical_data 
+            #display_categorical_data(landuse_data, '../data/un_lcc_color_scheme.csv')
+
+            #import sys
+            #sys.exit()
+
+            # Load the protected areas for the countries which intersect the
+            # raster. The protected areas are dissolved into a single
+            # multipolygon geometry, and projected to match the raster CRS.
+            # !!! This could be made more efficient: Pre-process with a spatial
+            # join to assign each protected area with adm1 zone(s). Then we
+            # only need to load the PAs matching adm1.
+            PA_geom = load_protected_areas_for_raster_clipping(path_PA_gpkg,
+                                adm0_list, crs, raster_bounds = raster_src.bounds)
+
+            pixel_area_km2 = calculate_pixel_area_km2(raster_src.transform)
 
         # Reproject polygons.
-        if polygons_GDF is not None:
-
-           polygons_GDF = polygons_GDF.to_crs(dst_crs)
-
-        # Do binning.
-        results_for_all_polygon_groups__dict[polygons_name] =\
-                bin_raster_for_one_polygon_group(
-                            raster_src, raster_data,
-                            bins, PA_mask,
-                            landuse_src,
+        dict_of_polygon_GDFs = {
+                polygons_name : (None if polygons_GDF is None
+                                 else polygons_GDF.to_crs(crs))
+                for polygons_name, polygons_GDF
+                in dict_of_polygon_GDFs.items()}
+
+        # Do the binning.
+        #
+        # Give a warning if the bins do not encompass the full range of
+        # values in the raster.
+        #min_bin, max_bin = bins[0], bins[-1]
+        #if  ((raster_data.min() / scale_factor) < min_bin) or\
+        #    ((raster_data.max() / scale_factor) > max_bin):
+        #    warnings.warn("Some raster values fall outside the defined bins.")
+        #
+        # The polygon groups are independent, so they are counted in
+        # parallel, one process per group. The Numba threads are shared
+        # out between the processes.
+        n_workers = max(min(len(dict_of_polygon_GDFs), os.cpu_count()), 1)
+        n_threads_per_worker = max(numba.config.NUMBA_NUM_THREADS // n_workers,
+                                   1)
+        logging.info('Counting pixels for {:d} polygon groups with {:d} processes'
+                     .format(len(dict_of_polygon_GDFs), n_workers))
+        with ProcessPoolExecutor(max_workers = n_workers,
+                    mp_context = multiprocessing.get_context('spawn'),
+                    initializer = numba.set_num_threads,
+                    initargs = (n_threads_per_worker,)) as executor:
+
+            futures = {
+                polygons_name : executor.submit(
+                            count_pixels_for_one_polygon_group_from_paths,
+                            path_raster, raster_band, path_landuse,
+                            bins, PA_geom, landuse_categories,
+                            polygons_GDF)
+                for polygons_name, polygons_GDF
+                in dict_of_polygon_GDFs.items()}
+
+            # Prepare output dictionary.
+            results_for_all_polygon_groups__dict = dict()
+            # Loop over lists of polygons (in order).
+            for polygons_name, polygons_GDF in dict_of_polygon_GDFs.items():
+
+                counts, counts_PA, counts_landuse = \
+                        futures[polygons_name].result()
+
+                results_for_all_polygon_groups__dict[polygons_name] =\
+                        summarise_bin_counts_for_one_polygon_group(
+                            counts, counts_PA, counts_landuse,
+                            bins, landuse_categories, pixel_area_km2,
                             polygon_id_field_dict[polygons_name],
-                            polygons_GDF = polygons_GDF,
-                            polygons_name = polygons_name)
+                            polygons_name = polygons_name,
+                            polygons_GDF = polygons_GDF)
 
     ## Flatten the results dictionary (makes it easier to manipulate later).
     #results_flat = {}
@@ -121,88 +174,277 @@ def bin_raster_for_all_polygon_groups(path_raster, path_PA_gpkg,
     #return binned, profile
     return results_for_all_polygon_groups__dict
 
-def bin_raster_for_one_polygon_group(raster_src, raster_data,
-                bins, PA_mask, landuse_src, polygon_id_field,
-                polygons_name = 'whole', polygons_GDF = None):
+def count_pixels_for_one_polygon_group_from_paths(path_raster, raster_band,
+                path_landuse, bins, PA_geom, landuse_categories,
+                polygons_GDF):
+
+    # Open the raster and the land use raster (warped on the fly to the
+    # grid of the raster, so only the tiles which are read are
+    # reprojected), and count the pixels.
+    with rasterio.open(path_raster) as raster_src, \
+         rasterio.open(path_landuse) as landuse_src_unwarped, \
+         open_warped_to_match(raster_src, landuse_src_unwarped,
+                              resampling = Resampling.mode) as landuse_src:
+
+        return count_pixels_for_one_polygon_group(raster_src, raster_band,
+                    bins, PA_geom, landuse_src, landuse_categories,
+                    polygons_GDF = polygons_GDF)
+
+def count_pixels_for_one_polygon_group(raster_src, raster_band,
+                bins, PA_geom, landuse_src, landuse_categories,
+                polygons_GDF = None):
+
+    # Split the protected areas into their parts, and build a spatial
+    # index, so that only the parts which overlap each tile are rasterized.
+    if PA_geom is None or PA_geom.is_empty:
+        PA_parts = np.zeros(0, dtype = object)
+    else:
+        PA_parts = shapely.get_parts(PA_geom)
+    PA_tree = shapely.STRtree(PA_parts)
+
+    # Case 1: No list of polygons has been provided (do binning for the
+    # whole raster, with no polygon clipping). All pixels are in zone 0.
+    if polygons_GDF is None:
+
+        polygon_geoms = None
+        polygons_tree = None
+        n_zones = 1
+
+    # Case 2: A list of polygons has been provided. The zones of the
+    # polygons are 1 to n_polys (zone 0 is outside all of them). In each
+    # tile, the polygons are rasterized so that each pixel is labelled with
+    # the polygon which contains it. A spatial index is used to find the
+    # polygons in each tile.
+    else:
+
+        polygon_geoms = polygons_GDF.geometry.values
+        polygons_tree = shapely.STRtree(polygon_geoms)
+        n_zones = len(polygons_GDF) + 1
+
+    # Prepare the count arrays, which are summed over the tiles.
+    n_bin_ids = len(bins) + 1
+    n_cats = len(landuse_categories)
+    counts = np.zeros((n_zones, n_bin_ids), dtype = np.int64)
+    counts_PA = np.zeros((n_zones, n_bin_ids), dtype = np.int64)
+    counts_landuse = np.zeros((n_zones, n_cats, n_bin_ids), dtype = np.int64)
+
+    # Allocate the tile buffers once, and reuse them for every tile (the
+    # edge tiles use a smaller part of each buffer).
+    n_tile_pixels = BINNING_TILE_SIZE * BINNING_TILE_SIZE
+    raster_dtype = raster_src.dtypes[raster_band - 1]
+    buffer_data = np.empty(n_tile_pixels, dtype = raster_dtype)
+    buffer_mask = np.empty(n_tile_pixels, dtype = np.uint8)
+    buffer_PA = np.empty(n_tile_pixels, dtype = np.uint8)
+    buffer_zones = np.empty(n_tile_pixels, dtype = np.int32)
+    buffer_landuse = np.empty(n_tile_pixels, dtype = landuse_src.dtypes[0])
+
+    # Count the pixels by zone and bin (in total and in protected areas),
+    # and by zone, land use category and bin, one tile at a time (to
+    # limit the memory use).
+    for window in iterate_raster_windows(raster_src.height, raster_src.width,
+                                         BINNING_TILE_SIZE):
+
+        # Find the polygons which overlap this tile. Skip the tile if
+        # there are none.
+        transform_window = raster_src.window_transform(window)
+        tile_box = shapely.box(*windows.bounds(window, raster_src.transform))
+        if polygons_tree is not None:
+
+            hits = polygons_tree.query(tile_box)
+            if hits.size == 0:
+                continue
+
+        # Read the tile, and skip it if it has no valid pixels.
+        tile_shape = (window.height, window.width)
+        raster_mask = raster_src.read_masks(raster_band, window = window,
+                            out = get_buffer_view(buffer_mask, tile_shape))
+        if not raster_mask.any():
+            continue
+        raster_data = raster_src.read(raster_band, window = window,
+                            out = get_buffer_view(buffer_data, tile_shape))
+
+        # Rasterize the protected areas and polygons for this tile.
+        # The polygons are numbered from 1 within the tile (0 is outside
+        # all of them), and zone_ids gives the zone of each number, so
+        # the counts for the tile only need space for the zones in it.
+        PA_hits = PA_tree.query(tile_box)
+        in_PA = rasterize_PA_mask(PA_parts[PA_hits], tile_shape,
+                            transform_window,
+                            out = get_buffer_view(buffer_PA, tile_shape))
+        if polygons_tree is None:
+            zones = None
+            zone_ids = np.zeros(1, dtype = np.int64)
+        else:
+            zones = rasterize_polygon_zones(polygon_geoms[hits],
+                            range(1, hits.size + 1),
+                            tile_shape, transform_window,
+                            out = get_buffer_view(buffer_zones, tile_shape))
+            zone_ids = np.concatenate(([0], hits + 1)).astype(np.int64)
+
+        # Read the land use for this tile (warping it to the raster grid).
+        landuse_data = landuse_src.read(1, window = window,
+                            out = get_buffer_view(buffer_landuse, tile_shape))
+        landuse_codes, landuse_valid = encode_landuse_categories(
+                                        landuse_data, landuse_categories)
+
+        # Count the pixels in this tile.
+        count_by_zone_and_bin(zones, zone_ids, raster_data, raster_mask,
+                              bins, in_PA,
+                              landuse_codes, landuse_valid,
+                              counts, counts_PA, counts_landuse)
+
+    return counts, counts_PA, counts_landuse
+
+def summarise_bin_counts_for_one_polygon_group(counts, counts_PA,
+                counts_landuse, bins, landuse_categories, pixel_area_km2,
+                polygon_id_field, polygons_name = 'whole',
+                polygons_GDF = None):
     
     logging.info('\n' + 80 * '-')
     logging.info('Binning raster for polygons list: {:}'.format(polygons_name))
+    logging.info('Doing binning with bins {:}'.format(str(bins)))
 
-    # Determine the length of the loop.
+    # Case 1: No list of polygons has been provided; the whole raster is
+    # zone 0.
     if polygons_GDF is None:
-        n_polys = 1
+
+        zone_list = [0]
+        polygon_names = ['whole']
+        polygon_ids = ['whole']
+
+    # Case 2: A list of polygons has been provided; the polygons are
+    # zones 1 to n_polys.
     else:
-        n_polys = len(polygons_GDF)
-    
-    # Loop over each polygon to do binning.
+
+        zone_list = range(1, len(polygons_GDF) + 1)
+        polygon_names = list(polygons_GDF['name'])
+        polygon_ids = list(polygons_GDF[polygon_id_field])
+
+    # Convert the counts for each polygon into areas.
+    n_polys = len(zone_list)
     results_for_all_polygons_in_group__dict = dict()
-    for i in range(n_polys):
+    for i, zone in enumerate(zone_list):
 
-        # Do binning for one polygon.
-        polygon_id, results_for_one_polygon__dict = \
-                bin_raster_for_one_polygon(polygons_GDF, i, raster_data,
-                                    raster_src, PA_mask,
-                                    landuse_src, bins,
-                                    n_polys, polygon_id_field)
+        results_for_one_polygon__dict = get_bin_areas_for_one_zone(
+                counts[zone], counts_PA[zone], counts_landuse[zone],
+                landuse_categories, pixel_area_km2)
+
+        # Print an update.
+        area_km2 = counts[zone].sum() * pixel_area_km2
+        area_km2_PA = counts_PA[zone].sum() * pixel_area_km2
+        print_bin_count_update(i, n_polys, polygon_names[i],
+                               results_for_one_polygon__dict,
+                               area_km2, area_km2_PA,
+                               area_km2 - area_km2_PA)
 
         # Store array for this polygon in dictionary.
-        results_for_all_polygons_in_group__dict[polygon_id] =\
+        results_for_all_polygons_in_group__dict[polygon_ids[i]] =\
                 results_for_one_polygon__dict
 
     return results_for_all_polygons_in_group__dict
 
-def bin_raster_for_one_polygon(polygons_GDF, i, raster_data, raster_src,
-                               PA_mask, landuse_src, bins,
-                               n_polys, polygon_id_field):
-
-    # Apply the protected areas mask and get polygon name and ID.
-    raster_data, raster_data_PA, polygon_name, polygon_id, landuse_data =\
-        prepare_PA_masked_raster_and_metadata(polygons_GDF, i, raster_data,
-                                            raster_src, PA_mask, landuse_src,
-                                            polygon_id_field)
-
-    #from plot_categorical_data import display_categorical_data 
-    #display_categorical_data(landuse_data, '../data/un_lcc_color_scheme.csv')
-
-    # Get pixel size and counts for the current raster (after clipping).
-    pxl_info = calculate_pixel_size_and_counts(raster_src.profile,
-                                            raster_data,
-                                            verbose = False)
-
-    # Get pixel size and counts for the current raster (after clipping
-    # and masking by protected areas).
-    pxl_info_PA = calculate_pixel_size_and_counts(raster_src.profile,
-                                            raster_data_PA,
-                                            verbose = False)
-
-    ## Summarise amount of protected area.
-    #area_unmasked_and_unprotected_km2_i = \
-    #        area_unmasked_km2_i - area_unmasked_and_protected_km2_i
-    #frac_protected_i = \
-    #        area_unmasked_and_protected_km2_i / area_unmasked_km2_i
-    #frac_unprotected_i = 1.0 - frac_protected_i
-
-    # Do binning and get bin counts for the data with and without the
-    # protected areas mask.
-    results_for_one_polygon__dict = get_bin_counts_wrapper(
-            raster_data, raster_data_PA, landuse_data, bins,
-            pxl_info['pixel_area_km2'])
-
-    # Print an update.
-    print_bin_count_update(i, n_polys, polygon_name,
-                           results_for_one_polygon__dict,
-            pxl_info['area_unmasked_km2'],
-            pxl_info_PA['area_unmasked_km2'],
-            pxl_info['area_unmasked_km2'] - pxl_info_PA['area_unmasked_km2'])
-
-    return polygon_id, results_for_one_polygon__dict
-
-def get_bin_counts_wrapper(data, data_PA, landuse_data, bins,
-                           pixel_area_km2):
-
-    # Get bin counts.
-    counts_by_bin, data_binned = get_bin_counts(data, bins)
-    counts_by_bin_in_PA, _ = get_bin_counts(data_PA, bins)
+def find_landuse_categories(landuse_src, raster_src, buffer):
+
+    # Transform the raster bounds to the land use CRS, and add a buffer
+    # (so that the categories of any land use pixels which contribute to
+    # the resampling at the edges are included).
+    landuse_bounds = transform_bounds(raster_src.crs, landuse_src.crs,
+                                      *raster_src.bounds)
+    landuse_bounds = (landuse_bounds[0] - buffer, landuse_bounds[1] - buffer,
+                      landuse_bounds[2] + buffer, landuse_bounds[3] + buffer)
+
+    # Read the land use in this region (at its own resolution).
+    try:
+        window = windows.from_bounds(*landuse_bounds, landuse_src.transform)
+        window = window.round_offsets().round_lengths().intersection(
+                    windows.Window(0, 0, landuse_src.width, landuse_src.height))
+    except WindowError:
+        logging.info("Warning: Bounds don't overlap with landuse raster")
+        return np.zeros(0, dtype = landuse_src.dtypes[0])
+    landuse_data = landuse_src.read(1, window = window)
+
+    # Find the categories which are present, excluding nodata.
+    # For 8-bit land use rasters (such as UN LCC), a bincount is faster
+    # than sorting all of the pixels.
+    if landuse_data.dtype == np.uint8:
+        present = np.bincount(landuse_data.ravel(), minlength = 256) > 0
+        landuse_categories = np.flatnonzero(present).astype(np.uint8)
+    else:
+        landuse_categories = np.unique(landuse_data)
+    if landuse_src.nodata is not None:
+        landuse_categories = landuse_categories[
+                                landuse_categories != landuse_src.nodata]
+
+    return landuse_categories
+
+def encode_landuse_categories(landuse_data, landuse_categories):
+
+    # Encode each land use category as an integer from 0 to n_cats - 1.
+    # For 8-bit land use rasters (such as UN LCC), a lookup table is faster
+    # than a search.
+    n_cats = landuse_categories.size
+    if landuse_data.dtype == np.uint8:
+        lookup_table = np.zeros(256, dtype = np.uint8)
+        lookup_table[landuse_categories] = np.arange(n_cats, dtype = np.uint8)
+        landuse_codes = lookup_table[landuse_data]
+    else:
+        landuse_codes = np.searchsorted(landuse_categories, landuse_data)
+        np.clip(landuse_codes, 0, max(n_cats - 1, 0), out = landuse_codes)
+
+    # Land use pixels are valid if they have one of the categories (this
+    # excludes nodata).
+    if n_cats == 0:
+        landuse_valid = np.zeros(landuse_data.shape, dtype = bool)
+    else:
+        landuse_valid = (landuse_categories[landuse_codes] == landuse_data)
+
+    return landuse_codes, landuse_valid
+
+def count_by_zone_and_bin(zones, zone_ids, data, data_mask, bins, in_PA,
+                          landuse_codes, landuse_valid,
+                          counts, counts_PA, counts_landuse):
+
+    # The valid pixels (non-zero in data_mask) are binned, and the counts
+    # are added to the arrays counts (zone, bin), counts_PA (zone, bin)
+    # and counts_landuse (zone, land use category, bin). The zones array
+    # holds local zone numbers, which are indices into zone_ids.
+
+    # Without zones, a small placeholder array is passed to the kernel
+    # (it is never read).
+    has_zones = zones is not None
+    if not has_zones:
+        zones = np.zeros((1, 1), dtype = np.int32)
+
+    # Skip the protected area and land use counts entirely if there are no
+    # protected areas or no valid land use pixels (their counts stay at
+    # zero).
+    has_PA = bool(in_PA.any())
+    has_landuse = bool(landuse_valid.any())
+
+    # Bin the pixels and count them for each (zone, bin) pair (in total
+    # and in protected areas) and each (zone, land use category, bin)
+    # triple, with a single parallel pass over the pixels.
+    accumulate_counts_by_zone_and_bin(
+            np.ascontiguousarray(zones, dtype = np.int32), zone_ids, has_zones,
+            np.ascontiguousarray(data),
+            np.ascontiguousarray(data_mask),
+            np.asarray(bins, dtype = np.float64),
+            np.ascontiguousarray(in_PA), has_PA,
+            np.ascontiguousarray(landuse_codes),
+            np.ascontiguousarray(landuse_valid), has_landuse,
+            counts, counts_PA, counts_landuse,
+            max(min(numba.get_num_threads(), data.shape[0]), 1))
+
+    return
+
+def get_bin_areas_for_one_zone(counts, counts_PA, counts_landuse,
+                               landuse_categories, pixel_area_km2):
+
+    # Get bin counts. Bin index 0 (below the first edge) and n_bin_ids - 1
+    # (at or above the last edge) are not counted.
+    n_bin_ids = counts.shape[0]
+    counts_by_bin = counts[1 : n_bin_ids - 1]
+    counts_by_bin_in_PA = counts_PA[1 : n_bin_ids - 1]
     counts_by_bin_not_in_PA = counts_by_bin - counts_by_bin_in_PA
 
     # Get bin areas.
@@ -210,20 +452,21 @@ def get_bin_counts_wrapper(data, data_PA, landuse_data, bins,
     areas_km2_by_bin_in_PA = counts_by_bin_in_PA * pixel_area_km2
     areas_km2_by_bin_not_in_PA = counts_by_bin_not_in_PA * pixel_area_km2
 
-    # Calculate bin areas, double-binned by land use category.
-    areas_km2_by_category_and_bin = count_binned_by_category(data_binned,
-                                        landuse_data, pixel_area_km2)
+    # Calculate bin areas, double-binned by land use category (only for
+    # the categories which are present in this zone).
+    areas_km2_by_category_and_bin = dict()
+    if counts_landuse.any():
+        present = counts_landuse.sum(axis = 1) > 0
+        areas_km2_by_category_and_bin = {
+                cat_val.item() :
+                    (counts_landuse[j, 1 : n_bin_ids - 1] * pixel_area_km2).tolist()
+                for j, cat_val in enumerate(landuse_categories) if present[j]}
     
-    #logging.info(areas_km2_by_category_and_bin)
-    #logging.info('\n')
     for landuse_category, val in areas_km2_by_category_and_bin.items():
         logging.info('{:>4d} {:10.1f} {:10.1f} {:10.1f} {:10.1f} km2'.format(
             landuse_category, *val))
 
-    # Store the information for this group of polygons.
-    #areas_km2_by_bin_array = np.stack([
-    #    areas_km2_by_bin, areas_km2_by_bin_in_PA,
-    #    areas_km2_by_bin_not_in_PA], axis = 1)
+    # Store the information for this polygon.
     results_for_one_polygon__dict = {
         'area_km2_by_bin' : areas_km2_by_bin,
         'area_km2_by_bin_in_PA' : areas_km2_by_bin_in_PA,
@@ -231,32 +474,8 @@ def get_bin_counts_wrapper(data, data_PA, landuse_data, bins,
         'area_km2_by_landuse_and_bin' : areas_km2_by_category_and_bin,
         }
 
-    #return areas_km2_by_bin_array
     return results_for_one_polygon__dict
 
-def get_bin_counts(data_with_mask, bins):
-
-    ## Apply the scale factor (some rasters use a range not between
-    ## 0 and 1, for example to allow smaller file sizes by saving as
-    ## Int16 format).
-    #data_with_mask = data_with_mask / scale_factor
-    logging.info('Doing binning with bins {:}'.format(str(bins)))
-
-    # Bin the data and re-apply the mask.
-    binned = np.digitize(data_with_mask, bins, right = False)
-    binned = np.ma.masked_array(binned, mask = data_with_mask.mask)
-
-    # Get counts for each bin, ignoring masked values.
-    n_bins = len(bins) - 1
-    counts_by_bin = np.zeros(n_bins, dtype = int)
-    for i in range(1, len(bins)):
-        
-        #counts_by_bin[i - 1] = np.sum((binned == i) & ~binned.mask)
-        masked_equals_i = np.ma.masked_not_equal(binned, i)
-        counts_by_bin[i - 1] = np.ma.count(masked_equals_i)
-
-    return counts_by_bin, binned
-
 def print_bin_count_update(i, n_polys, polygon_name, results_for_one_polygon__dict, total_area, total_area_protected, total_area_unprotected):
 
     # Print update.
@@ -279,24 +498,3 @@ def print_bin_count_update(i, n_polys, polygon_name, results_for_one_polygon__di
                 ))
 
     return
-
-def count_binned_by_category(binned, category, multiplier):
-    result = {}
-
-    # Masked elements: ignore any location where either is masked
-    combined_mask = np.ma.getmaskarray(binned) | np.ma.getmaskarray(category)
-
-    # Get valid data
-    valid_binned = binned[~combined_mask]
-    valid_category = category[~combined_mask]
-
-    # Loop through unique category values
-    for cat_val in np.unique(valid_category):
-        counts = [0, 0, 0, 0]  # Assuming binned values are 0,1,2,3
-        # Filter binned values corresponding to current category
-        binned_for_cat = valid_binned[valid_category == cat_val]
-        for i in range(4):
-            counts[i] = np.sum(binned_for_cat == i + 1)
-        result[cat_val] = [c * multiplier for c in counts]
-
-    return result
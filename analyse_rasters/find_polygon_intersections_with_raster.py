@@ -1,48 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
 
 import geopandas as gpd
 import numpy as np
+import pyogrio
+from pyproj import CRS
 import rasterio
 #from rasterio.features import shapes
-from shapely.geometry import (GeometryCollection, MultiPolygon, Polygon)
+from rasterio.warp import transform_bounds
+import shapely
+from shapely.geometry import (GeometryCollection, MultiPolygon)
 #from shapely.ops import unary_union
 
+from analyse_rasters.projection_tools import get_cached_transformer
 from analyse_rasters.raster_utils import (
         get_non_null_region_of_raster_as_multipolygon,
+        read_band_with_valid_mask,
         summarise_raster,
         )
-from utilities.handle_vector_files import load_gpkg_filtered_by_list_as_gdf
+from utilities.handle_vector_files import (
+        get_gpkg_layer_crs, load_gpkg_filtered_by_list_as_gdf)
+
+# The raster outline and the polygons are reprojected into the same CRS
+# (a global equal-area CRS, the Mollweide projection).
+EPSG_MOLLWEIDE = "ESRI:54009"
+CRS_FOR_INTERSECTIONS = EPSG_MOLLWEIDE
 
 def find_which_polygons_intersect_raster_wrapper(path_adm0, path_adm1, path_raster, raster_band):
     
-    # Load the country outlines (admin-0 boundaries).
-    logging.info("Loading adm-0 file {:}".format(path_adm0))
-    gdf_adm0 = gpd.read_file(path_adm0)
-
-    # Load the raster, read the first band (with masking), and print summary.
+    # Load the raster, read the first band (and which of its pixels are
+    # valid), and print summary.
     logging.info("Loading raster file {:}".format(path_raster))
     raster_src = rasterio.open(path_raster)
-    raster_data = raster_src.read(raster_band, masked=True)
-    raster_summary = summarise_raster(raster_src, raster_data)
+    raster_data, raster_valid = read_band_with_valid_mask(raster_src,
+                                                          raster_band)
+    raster_summary = summarise_raster(raster_src, raster_data, raster_valid)
+
+    # Load the country outlines (admin-0 boundaries). Only the countries
+    # which overlap the bounding box of the raster, and only the columns
+    # which are needed, are read from the file.
+    logging.info("Loading adm-0 file {:}".format(path_adm0))
+    bbox = transform_bounds(raster_src.crs, get_gpkg_layer_crs(path_adm0),
+                            *raster_src.bounds)
+    gdf_adm0 = pyogrio.read_dataframe(path_adm0, columns = ['name', 'iso3'],
+                                      bbox = bbox)
+
+    # Get the outline of the raster once, for both the adm-0 and adm-1
+    # intersections.
+    raster_geom = get_raster_outline_for_intersections(raster_valid,
+                                                       raster_src)
 
     # Determine which countries the raster intersects with.
     cols_to_keep = ['name', 'iso3']
     region_name_with_plural = ['country', 'countries']
     intersections_adm0 = find_which_polygons_intersect_raster(
                                             gdf_adm0,
-                                            raster_data, raster_src,
+                                            raster_valid, raster_src,
                                             cols_to_keep,
                                             region_name_with_plural,
-                                            id_field = 'iso3')
+                                            id_field = 'iso3',
+                                            raster_geom = raster_geom)
 
     # Get a list of the ISO codes of the countries intersected.
     list_of_adm0 = sorted(list(intersections_adm0['iso3'].unique()))
 
     # Load admin-1 boundaries, but only those that are for countries which
-    # intersect the raster.
+    # intersect the raster, and which overlap the bounding box of the
+    # raster (so the filtering is done by GDAL when reading the file).
     filter_field = 'adm0_iso3'
+    bbox = transform_bounds(raster_src.crs, get_gpkg_layer_crs(path_adm1),
+                            *raster_src.bounds)
     gdf_adm1 = load_gpkg_filtered_by_list_as_gdf(path_adm1,
-                            filter_field, list_of_adm0)
+                            filter_field, list_of_adm0, bbox = bbox)
     logging.info('')
 
     # Determine which admin-1 areas the raster intersects with.
@@ -50,10 +80,11 @@ def find_which_polygons_intersect_raster_wrapper(path_adm0, path_adm1, path_rast
     region_name_with_plural = ['adm1 zone', 'adm1 zones']
     intersections_adm1 = find_which_polygons_intersect_raster(
                                             gdf_adm1,
-                                            raster_data, raster_src,
+                                            raster_valid, raster_src,
                                             cols_to_keep,
                                             region_name_with_plural,
-                                            id_field = 'adm1_code')
+                                            id_field = 'adm1_code',
+                                            raster_geom = raster_geom)
 
     # Get a list of the codes of the admin-1 zones intersected.
     list_of_adm1 = sorted(list(intersections_adm1['adm1_code'].unique()))
@@ -62,30 +93,31 @@ def find_which_polygons_intersect_raster_wrapper(path_adm0, path_adm1, path_rast
             intersections_adm1, list_of_adm1, \
             raster_summary
 
-def find_which_polygons_intersect_raster(polygons, raster_data, raster_src,
+def find_which_polygons_intersect_raster(polygons, raster_valid, raster_src,
                                          cols_to_keep, region_name_with_plural,
-                                         id_field = 'iso3'):
+                                         id_field = 'iso3',
+                                         raster_geom = None):
 
     logging.info(80 * '-')
     logging.info("Finding which {:} intersect with the raster.".format(
         region_name_with_plural[1]))
 
-    # Unpack raster information.
-    transform = raster_src.transform
-    raster_crs = raster_src.crs
+    # Get the outline of the raster (unless it has already been calculated).
+    if raster_geom is None:
+        raster_geom = get_raster_outline_for_intersections(raster_valid,
+                                                           raster_src)
+
+    # Reproject the polygons into the same CRS as the raster outline.
+    polygons = polygons.to_crs(CRS_FOR_INTERSECTIONS)
+
+    # Discard the polygons which don’t touch the raster at all, so the
+    # expensive intersection is only calculated for the rest. The spatial
+    # index narrows the candidates by bounding box, and only those are
+    # tested against the (prepared) raster outline.
+    shapely.prepare(raster_geom)
+    idx_touching = polygons.sindex.query(raster_geom, predicate='intersects')
+    polygons = polygons.iloc[np.sort(idx_touching)]
 
-    # Get the non-null part of the raster as a MultiPolygon.
-    raster_geom = get_non_null_region_of_raster_as_multipolygon(
-            raster_data, transform)
-
-    # Reproject both the raster geometry and the polygons into the same
-    # CRS (the default is a global equal-area CRS, the Mollweide projection).
-    EPSG_MOLLWEIDE = "ESRI:54009"
-    crs_for_intersections = EPSG_MOLLWEIDE
-    raster_geom = gpd.GeoSeries([raster_geom], crs=raster_crs).to_crs(
-                    crs_for_intersections).iloc[0]
-    polygons = polygons.to_crs(crs_for_intersections)
-    
     # Find the intersections between the raster outline and the
     # polygons.
     intersections = find_intersection_regions_between_polygons_and_raster(
@@ -110,64 +142,93 @@ def find_which_polygons_intersect_raster(polygons, raster_data, raster_src,
     
     return intersections
 
-def find_intersection_regions_between_polygons_and_raster(polygons, raster_geom, cols_to_keep):
+def get_raster_outline_for_intersections(raster_valid, raster_src):
 
-    # Find where the raster’s outline intersects the polygons.
-    intersections = []
-    # Loop through the polygons.
-    for idx, polygon in polygons.iterrows():
+    # Get the non-null part of the raster as a MultiPolygon.
+    raster_geom = get_non_null_region_of_raster_as_multipolygon(
+            raster_valid, raster_src.transform)
 
-        # For each polygon, find the part which intersects the
-        # outline of the raster.
-        data_to_store = \
-            find_intersection_between_one_polygon_and_raster(
-                    polygon, raster_geom, cols_to_keep)
+    # Reproject the raster geometry into the CRS used for intersections,
+    # transforming all of its coordinates in one call.
+    transformer = get_cached_transformer(CRS(raster_src.crs).to_wkt(),
+                                         CRS(CRS_FOR_INTERSECTIONS).to_wkt())
+    raster_geom = shapely.transform(raster_geom,
+                    lambda xy: np.column_stack(
+                        transformer.transform(xy[:, 0], xy[:, 1])))
 
-        # Store in the list.
-        if data_to_store is not None:
+    return raster_geom
 
-            intersections.append(data_to_store)
+def find_intersection_regions_between_polygons_and_raster(polygons, raster_geom, cols_to_keep):
 
-    # Convert the list to a GeoDataFrame.
-    intersections = gpd.GeoDataFrame(intersections, crs = polygons.crs)
+    # Find where the raster’s outline intersects the polygons.
+    polygon_geoms = polygons.geometry.to_numpy()
+    intersection_geoms = np.empty(len(polygon_geoms), dtype = object)
+
+    # The intersection doesn't need to be calculated if the polygon lies
+    # entirely inside the raster outline, or vice versa. These are checked
+    # with prepared geometries (the raster outline, and each polygon).
+    shapely.prepare(raster_geom)
+    shapely.prepare(polygon_geoms)
+    polygon_inside_raster = shapely.contains_properly(raster_geom,
+                                                      polygon_geoms)
+    raster_inside_polygon = (~polygon_inside_raster &
+                    shapely.contains_properly(polygon_geoms, raster_geom))
+    intersection_geoms[polygon_inside_raster] = \
+            polygon_geoms[polygon_inside_raster]
+    intersection_geoms[raster_inside_polygon] = raster_geom
+
+    # The remaining intersections are calculated with vectorised calls
+    # (in parallel threads).
+    partial = ~(polygon_inside_raster | raster_inside_polygon)
+    intersection_geoms[partial] = intersect_geometries_in_parallel(
+                                    polygon_geoms[partial], raster_geom)
+
+    # Keep only the polygons which have some intersection.
+    kept = ~shapely.is_empty(intersection_geoms)
+    intersection_geoms = intersection_geoms[kept]
+
+    # Tidy up the geometries (there can be some Line features
+    # which have no area). Only the GeometryCollections need fixing.
+    is_collection = (shapely.get_type_id(intersection_geoms) ==
+                     shapely.GeometryType.GEOMETRYCOLLECTION)
+    for i in np.flatnonzero(is_collection):
+
+        intersection_geoms[i] = geometryCollection_to_multipolygon(
+                                    intersection_geoms[i])
+
+    type_ids = shapely.get_type_id(intersection_geoms)
+    assert np.all((type_ids == shapely.GeometryType.POLYGON) |
+                  (type_ids == shapely.GeometryType.MULTIPOLYGON)), \
+            'Expected only Polygon or MultiPolygon shapely geometries.'
+
+    # Build the GeoDataFrame of intersections in one step, from the
+    # sliced column arrays (the geometry arrays carry the CRS).
+    data = {'original_poly_geometry' : polygons.geometry.values[kept]}
+    for col in cols_to_keep:
+        data[col] = polygons[col].to_numpy()[kept]
+    intersections = gpd.GeoDataFrame(data, geometry = intersection_geoms,
+                                     crs = polygons.crs)
 
     return intersections
 
-def find_intersection_between_one_polygon_and_raster(polygon, raster_geom, cols_to_keep):
-
-    # Calculate intersection.
-    intersection = polygon.geometry.intersection(raster_geom)
-
-    # Store the intersection (if there is any).
-    if not intersection.is_empty:
+def intersect_geometries_in_parallel(geoms, other_geom, n_workers = None):
 
-        # Tidy up the geometry (there can be some Line features
-        # which have no area).
-        if isinstance(intersection, GeometryCollection):
-            
-            intersection = geometryCollection_to_multipolygon(
-                    intersection)
-
-        else:
-
-            assert  isinstance(intersection, MultiPolygon) or \
-                    isinstance(intersection, Polygon), \
-                    'Expected a Polygon or MultiPolygon shapely geometry, '\
-                    'but instead got {:}'.format(type(intersection))
-
-        # Store the intersection in a list.
-        data_to_store = {
-            'original_poly_geometry' : polygon.geometry,
-            'geometry' : intersection,
-            }
-        for col in cols_to_keep:
-            data_to_store[col] = polygon[col]
-
-    else:
+    # Split the geometries into contiguous chunks (one per worker) and
+    # intersect each chunk in a separate thread. Shapely releases the GIL
+    # during the GEOS operations, so the threads run in parallel.
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_chunks = min(n_workers, len(geoms))
+    if n_chunks <= 1:
+        return shapely.intersection(geoms, other_geom)
 
-        data_to_store = None
+    chunks = np.array_split(geoms, n_chunks)
+    with ThreadPoolExecutor(max_workers = n_chunks) as executor:
+        results = list(executor.map(
+                    lambda chunk: shapely.intersection(chunk, other_geom),
+                    chunks))
 
-    return data_to_store
+    return np.concatenate(results)
 
 def geometryCollection_to_multipolygon(geom_collection: GeometryCollection) -> MultiPolygon:
     """
@@ -187,37 +248,40 @@ def geometryCollection_to_multipolygon(geom_collection: GeometryCollection) -> M
     if not isinstance(geom_collection, GeometryCollection):
         raise ValueError("Input must be a GeometryCollection")
 
-    polygons: List[Polygon] = []
+    # Split the collection into its parts, and keep only the polygons and
+    # multipolygons (skipping Points, LineStrings, and other geometry types).
+    parts = shapely.get_parts(geom_collection)
+    type_ids = shapely.get_type_id(parts)
+    parts = parts[(type_ids == shapely.GeometryType.POLYGON) |
+                  (type_ids == shapely.GeometryType.MULTIPOLYGON)]
 
-    for geom in geom_collection.geoms:
-        if isinstance(geom, Polygon):
-            polygons.append(geom)
-        elif isinstance(geom, MultiPolygon):
-            # Extract individual polygons from MultiPolygon
-            polygons.extend(list(geom.geoms))
-        # Skip Points, LineStrings, and other geometry types
+    # Extract individual polygons from MultiPolygons.
+    polygons = shapely.get_parts(parts)
 
-    if not polygons:
+    if polygons.size == 0:
         raise ValueError("No polygons found in the GeometryCollection")
 
-    return MultiPolygon(polygons)
+    return shapely.multipolygons(polygons)
 
 def get_intersection_area_summary_values(raster_geom, intersections):
 
     raster_total_area_km2 = raster_geom.area / 1.0E6
 
-    intersections['area_of_intersection_km2'] = intersections['geometry'].area / 1.0E6
-    intersections['area_of_original_poly_km2'] = \
-        intersections['original_poly_geometry'].apply(
-                lambda geom: geom.area / 1.0E6)
+    # The areas are calculated with vectorised Shapely calls on the
+    # underlying geometry arrays.
+    area_of_intersection_km2 = shapely.area(
+            intersections['geometry'].to_numpy()) / 1.0E6
+    area_of_original_poly_km2 = shapely.area(
+            intersections['original_poly_geometry'].to_numpy()) / 1.0E6
+    intersections['area_of_intersection_km2'] = area_of_intersection_km2
+    intersections['area_of_original_poly_km2'] = area_of_original_poly_km2
 
-    # Calculate fractions.
+    # Calculate fractions (on the arrays, avoiding index alignment).
     intersections['frac_of_raster'] = (
-        intersections['area_of_intersection_km2'] / raster_total_area_km2)
+        area_of_intersection_km2 / raster_total_area_km2)
     #
     intersections['frac_of_original_poly'] = (
-        intersections['area_of_intersection_km2'] / 
-        intersections['area_of_original_poly_km2'])
+        area_of_intersection_km2 / area_of_original_poly_km2)
 
     # Sort by area of intersection.
     intersections.sort_values(by = 'area_of_intersection_km2', inplace = True,
@@ -262,8 +326,12 @@ def apply_thresholds_to_discard_intersection_areas(intersections):
 
     thresh_poly_frac = 0.01
     thresh_raster_frac = 0.01
+    # Discard intersections which are small both as a fraction of the
+    # polygon and as a fraction of the raster.
     intersections['discard'] = (
-            (intersections['frac_of_original_poly'] < thresh_poly_frac) &
-            (intersections['frac_of_raster'] < thresh_poly_frac))
+        np.less(intersections['frac_of_original_poly'].to_numpy(),
+                thresh_poly_frac) &
+        np.less(intersections['frac_of_raster'].to_numpy(),
+                thresh_raster_frac))
 
     return intersections
@@ -1,6 +1,7 @@
 import os
 import json
 import logging
+import re
 
 import numpy as np
 import pandas as pd
@@ -10,6 +11,9 @@ from interact_with_aws.aws_tools import (download_file_from_aws,
                                          upload_file_to_aws)
 from utilities.handle_logging import set_up_logging
 
+# Characters which are replaced by underscores in catalog keys.
+KEY_INVALID_CHARS_PATTERN = re.compile(r'[\W\s]+')
+
 def get_ready_wrapper(dir_base):
 
     # Define file paths.
@@ -108,11 +112,15 @@ def parse_catalog(path_catalog):
 def create_key(df, columns):
     """Create a key by joining specified columns with underscores and cleaning."""
 
+    # Join the columns with vectorised NumPy string operations.
+    key = df[columns[0]].to_numpy().astype(str)
+    for column in columns[1:]:
+        key = np.char.add(np.char.add(key, '_'),
+                          df[column].to_numpy().astype(str))
+
     return (
-        df[columns]
-        .astype(str)
-        .agg('_'.join, axis=1)
-        .str.replace(r'[\W\s]+', '_', regex=True)
+        pd.Series(key, index=df.index)
+        .str.replace(KEY_INVALID_CHARS_PATTERN, '_', regex=True)
         .str.strip('_')
     )
 
@@ -194,8 +202,6 @@ def define_results_path_for_dataset(dir_output, dataset_name):
 
 def load_all_results_from_aws(dir_output, catalog):
     
-    read_json = lambda filename: json.load(open(filename, 'r'))
-
     results = dict()
     for dataset_name, dataset in catalog.iterrows():
 
@@ -206,8 +212,9 @@ def load_all_results_from_aws(dir_output, catalog):
         path_dataset_results = define_results_path_for_dataset(
                 dir_output, dataset_name)
 
+        # The results are parsed straight from the downloaded stream.
         results[dataset_name] = download_and_parse_aws(
-                path_dataset_results, read_json)
+                path_dataset_results, parse_stream_func = json.load)
 
     return results
 
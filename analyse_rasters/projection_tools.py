@@ -1,11 +1,15 @@
+import functools
 import logging
+import os
+import tempfile
 
 import numpy as np
 from pyproj import CRS, Transformer
-import rasterio
-from rasterio.enums import Resampling
+from rasterio import windows
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.errors import WindowError
+from rasterio.vrt import WarpedVRT
 from rasterio.warp import (reproject, transform_bounds)
-from rasterio.windows import from_bounds
 from shapely.geometry import Polygon
 from shapely.ops import transform as sh_transform
 
@@ -14,6 +18,23 @@ from analyse_rasters.raster_utils import (
         get_non_null_region_of_raster_as_multipolygon,
         )
 
+CRS_WGS84 = CRS("EPSG:4326")
+REPROJECT_BLOCK_ROWS = 1024
+CENTROID_OUTLINE_MAX_PIXELS = 1000
+# GDAL's warper computes the source coordinates and samples the pixels in
+# parallel threads.
+REPROJECT_NUM_THREADS = os.cpu_count() or 1
+REPROJECT_WARP_MEM_LIMIT_MB = 512
+
+@functools.lru_cache(maxsize=128)
+def get_cached_transformer(src_crs_wkt, dst_crs_wkt):
+    """
+    Build a pyproj Transformer (with always_xy=True) between two CRSs given
+    as WKT strings. Building a Transformer is slow, so they are cached.
+    """
+    return Transformer.from_crs(CRS.from_wkt(src_crs_wkt),
+                                CRS.from_wkt(dst_crs_wkt), always_xy=True)
+
 def get_suitable_regional_projection_for_raster(raster_data, raster_src):
     
     logging.info('Finding a Lambert azimuthal equal area projection centred on the raster')
@@ -23,8 +44,12 @@ def get_suitable_regional_projection_for_raster(raster_data, raster_src):
     raster_crs = raster_src.crs
 
     # Get the non-null part of the raster as a MultiPolygon.
+    # Only the centroid is needed, so a coarse outline (at most about
+    # CENTROID_OUTLINE_MAX_PIXELS on the longer side) is accurate enough.
+    coarsen_factor = max(1, max(raster_data.shape) // CENTROID_OUTLINE_MAX_PIXELS)
     raster_geom = get_non_null_region_of_raster_as_multipolygon(
-            raster_data, transform)
+            ~np.ma.getmaskarray(raster_data), transform,
+            coarsen_factor = coarsen_factor)
 
     # Calculate the geographic centroid of the raster.
     lon_centroid, lat_centroid = geographic_true_centroid(
@@ -42,34 +67,49 @@ def get_suitable_regional_projection_for_raster(raster_data, raster_src):
 
     return laea_crs, centroid
 
-def geographic_true_centroid(polygon: Polygon, polygon_crs: CRS, tolerance: float = 1e-10, max_iterations: int = 10):
+def geographic_true_centroid(polygon: Polygon, polygon_crs: CRS, tolerance: float = 1e-10, max_iterations: int = 10, precise: bool = False):
     """
     Computes the true geographic centroid of a polygon on the ellipsoid
-    using iterative projection to an Azimuthal Equidistant projection.
+    using projection to a Lambert Azimuthal Equal Area projection centred
+    on the current estimate.
+
+    By default, only one projection is done (centred on the planar
+    centroid in the polygon's CRS). This is accurate to about a km for
+    regional polygons, which is enough for choosing the centre of a map
+    projection. If precise is True, the projection is repeated until the
+    centroid converges.
 
     Args:
         polygon (shapely.geometry.Polygon): The input polygon.
         polygon_crs (pyproj.CRS): The CRS of the input polygon (e.g., pyproj.CRS("EPSG:4326")).
-        tolerance (float): Convergence threshold in degrees.
-        max_iterations (int): Maximum number of iterations.
+        tolerance (float): Convergence threshold in degrees (if precise).
+        max_iterations (int): Maximum number of iterations (if precise).
+        precise (bool): Iterate until the centroid converges.
 
     Returns:
         (float, float): The true geographic centroid in geographic coordinates (lon, lat).
     """
     assert polygon.is_valid and not polygon.is_empty, "Invalid or empty polygon."
 
+    # Without the precise option, a single projection (centred on the
+    # planar centroid) is used instead of iterating to convergence.
+    if not precise:
+        max_iterations = 1
+
     # Start with the centroid in the polygon's native CRS
     initial_centroid = polygon.centroid
 
     # Define a transformer to geographic coordinates
-    to_geo = Transformer.from_crs(polygon_crs, CRS("EPSG:4326"), always_xy=True)
+    polygon_crs_wkt = CRS(polygon_crs).to_wkt()
+    to_geo = get_cached_transformer(polygon_crs_wkt, CRS_WGS84.to_wkt())
     lon, lat = to_geo.transform(initial_centroid.x, initial_centroid.y)
 
     for _ in range(max_iterations):
         # Define AEQD CRS centered on current (lon, lat)
         laea_crs = CRS.from_proj4(f"+proj=laea +lat_0={lat} +lon_0={lon} +datum=WGS84 +units=m +no_defs")
-        from_crs_to_laea = Transformer.from_crs(polygon_crs, laea_crs, always_xy=True).transform
-        from_laea_to_geo = Transformer.from_crs(laea_crs, CRS("EPSG:4326"), always_xy=True).transform
+        laea_crs_wkt = laea_crs.to_wkt()
+        from_crs_to_laea = get_cached_transformer(polygon_crs_wkt, laea_crs_wkt).transform
+        from_laea_to_geo = get_cached_transformer(laea_crs_wkt, CRS_WGS84.to_wkt()).transform
 
         # Reproject the polygon
         projected_polygon = sh_transform(from_crs_to_laea, polygon)
@@ -113,114 +153,126 @@ def reproject_raster_wrapper(raster_data, raster_src, profile):
 
     return dst_profile, dst_crs, dst_raster_data, centroid
 
-def reproject_raster(raster_data, height, width, raster_src, transform, dst_crs):
+def reproject_raster(raster_data, height, width, raster_src, transform, dst_crs, block_rows=REPROJECT_BLOCK_ROWS):
+
+    # The output is written to a temporary memory-mapped file, so the
+    # reprojected raster does not need to fit in RAM alongside the input.
+    # The memory map keeps its own (duplicate) handle to the file, so the
+    # file object is closed straight away. The file has no name, so its
+    # storage is freed when the memory map (the returned array) is
+    # released.
+    tmp_file = tempfile.TemporaryFile()
+    reprojected = np.memmap(tmp_file, mode='w+', shape=(height, width),
+                            dtype=raster_data.dtype)
+    tmp_file.close()
+    reprojected_mask = np.ones((height, width), dtype=bool)
+
+    # Reproject doesn’t handle masked arrays, so the nodata values are
+    # filled in (one block at a time). If the mask comes only from the
+    # nodata value of the file, the masked pixels already hold that value,
+    # so the underlying data can be used directly without a copy.
+    src_nodata = raster_data.fill_value
+    mask_is_from_nodata = ((raster_src.nodata is not None) and
+                           (raster_src.nodata == src_nodata) and
+                           all(flags == [MaskFlags.nodata]
+                               for flags in raster_src.mask_flag_enums))
+    # The mask is found by comparing with the nodata value as stored in
+    # the output (e.g. the default fill value 1e20 is not exactly
+    # representable as float32, so it would not match the value written).
+    nodata_as_dtype = np.asarray(src_nodata).astype(raster_data.dtype)
+
+    # Reproject one block of output rows at a time, using only the part
+    # of the input raster which covers that block.
+    for row_off in range(0, height, block_rows):
+
+        dst_window = windows.Window(0, row_off, width,
+                                    min(block_rows, height - row_off))
+        dst_block_transform = windows.transform(dst_window, transform)
+        dst_block = reprojected[windows.window_index(dst_window)]
+
+        # Find the window of the input raster which covers this block,
+        # padded by a pixel to avoid losing pixels at the edges.
+        # If the block is partly outside the valid area of the projection
+        # (the bounds are not finite), or it crosses the antimeridian (the
+        # left bound is greater than the right), the whole input raster is
+        # used instead.
+        src_bounds = transform_bounds(dst_crs, raster_src.crs,
+                            *windows.bounds(dst_window, transform))
+        if np.all(np.isfinite(src_bounds)) and (src_bounds[0] <= src_bounds[2]):
+            src_window = windows.from_bounds(*src_bounds,
+                                transform=raster_src.transform)
+            col_start = int(np.floor(src_window.col_off)) - 1
+            row_start = int(np.floor(src_window.row_off)) - 1
+            col_stop = int(np.ceil(src_window.col_off + src_window.width)) + 1
+            row_stop = int(np.ceil(src_window.row_off + src_window.height)) + 1
+            try:
+                src_window = windows.Window(col_start, row_start,
+                                            col_stop - col_start,
+                                            row_stop - row_start).intersection(
+                                windows.Window(0, 0, raster_src.width,
+                                               raster_src.height))
+            except WindowError:
+                dst_block[:] = src_nodata
+                continue
+        else:
+            src_window = windows.Window(0, 0, raster_src.width,
+                                        raster_src.height)
+        src_block = raster_data[windows.window_index(src_window)]
+        if mask_is_from_nodata:
+            src_block = np.ma.getdata(src_block)
+        else:
+            src_block = src_block.filled(src_nodata)
+
+        # Reproject. We have to use nearest neighbour interpolation, because
+        # we have nodata values which will otherwise cause interpolation
+        # artifacts.
+        reproject(
+            source=src_block,
+            destination=dst_block,
+            src_transform=windows.transform(src_window, raster_src.transform),
+            src_crs=raster_src.crs,
+            dst_transform=dst_block_transform,
+            dst_crs=dst_crs,
+            resampling=Resampling.nearest,
+            src_nodata=src_nodata,
+            dst_nodata=src_nodata,  # Same nodata value for output.
+            num_threads=REPROJECT_NUM_THREADS,
+            warp_mem_limit=REPROJECT_WARP_MEM_LIMIT_MB,
+        )
 
-    reprojected = np.empty((height, width), dtype=raster_data.dtype)
+        # Build the mask for this block while it is still in the cache.
+        np.equal(dst_block, nodata_as_dtype,
+                 out=reprojected_mask[windows.window_index(dst_window)])
 
-    # Reproject doesn’t handle masked arrays, so fill in the nodata values.
-    src_nodata = raster_data.fill_value
-    raster_data_filled = raster_data.filled(src_nodata)
-
-    # Reproject. We have to use nearest neighbour interpolation, because
-    # we have nodata values which will otherwise cause interpolation
-    # artifacts.
-    reproject(
-        #source=raster_data,
-        source=raster_data_filled,
-        destination=reprojected,
-        src_transform=raster_src.transform,
-        src_crs=raster_src.crs,
-        dst_transform=transform,
-        dst_crs=dst_crs,
-        resampling=Resampling.nearest,
-        src_nodata=src_nodata,
-        dst_nodata=src_nodata  # Same nodata value for output.
-    )
-    #raster_data = np.ma.masked_invalid(reprojected)
-
-    # Re-apply the mask.
-    raster_data = np.ma.masked_equal(reprojected, src_nodata)
+    # Re-apply the mask (without copying the data out of the memory map).
+    raster_data = np.ma.array(reprojected, mask=reprojected_mask,
+                              fill_value=src_nodata, copy=False)
 
     return raster_data
 
-def reproject_to_match(raster_src, path_second_raster, resampling=Resampling.nearest, buffer=0.01):
+def open_warped_to_match(raster_src, second_src, resampling=Resampling.nearest):
     """
-    Reproject a second raster to match the extent, projection, and grid of a reference raster.
-    Only processes the overlapping region for efficiency.
+    Open a second raster as a virtual raster which is warped on the fly to
+    the extent, projection, and grid of a reference raster. Only the
+    windows which are read are reprojected.
 
     Parameters:
     -----------
     raster_src : rasterio.DatasetReader
         Open rasterio dataset reader for the reference raster
-    path_second_raster : str
-        Path to the raster that needs to be reprojected
+    second_src : rasterio.DatasetReader
+        Open rasterio dataset reader for the raster to be warped
     resampling : rasterio.warp.Resampling, optional
         Resampling method to use (default: nearest)
-    buffer : float, optional
-        Buffer to add around bounds to avoid edge effects (default: 0.01)
 
     Returns:
     --------
-    tuple : (reprojected_data, profile)
-        reprojected_data : numpy.ndarray
-            The reprojected raster data
-        profile : dict
-            Rasterio profile dict for the reprojected data
+    rasterio.vrt.WarpedVRT
+        The warped virtual raster (to be closed by the caller)
     """
-    # Get reference properties
-    ref_transform = raster_src.transform
-    ref_crs = raster_src.crs
-    ref_shape = (raster_src.height, raster_src.width)
-    ref_bounds = raster_src.bounds
-
-    # Create the output profile based on reference raster
-    profile = raster_src.profile.copy()
-
-    with rasterio.open(path_second_raster) as second_src:
-        # Update profile with second raster's data type and nodata
-        profile.update({
-            'dtype': second_src.dtypes[0],
-            'nodata': second_src.nodata,
-            'count': 1  # assuming single band, adjust if needed
-        })
-
-        # Transform the reference bounds to the second raster's CRS
-        second_crs_bounds = transform_bounds(ref_crs, second_src.crs, *ref_bounds)
-
-        # Add buffer to ensure we don't miss edge pixels
-        buffered_bounds = (
-            second_crs_bounds[0] - buffer,
-            second_crs_bounds[1] - buffer,
-            second_crs_bounds[2] + buffer,
-            second_crs_bounds[3] + buffer
-        )
-
-        try:
-            # Get the window in the second raster that covers these bounds
-            window = from_bounds(*buffered_bounds, second_src.transform)
-
-            # Read only the relevant portion of the second raster
-            clipped_data = second_src.read(1, window=window)
-            clipped_transform = rasterio.windows.transform(window, second_src.transform)
-
-            # Create array for reprojected data
-            reprojected_data = np.empty(ref_shape, dtype=second_src.dtypes[0])
-
-            # Reproject only the clipped portion
-            reproject(
-                source=clipped_data,
-                destination=reprojected_data,
-                src_transform=clipped_transform,
-                src_crs=second_src.crs,
-                dst_transform=ref_transform,
-                dst_crs=ref_crs,
-                resampling=resampling
-            )
-
-        except rasterio.errors.WindowError:
-            logging.info("Warning: Bounds don't overlap with second raster")
-            # Return array filled with nodata values
-            fill_value = second_src.nodata if second_src.nodata is not None else 0
-            reprojected_data = np.full(ref_shape, fill_value, dtype=second_src.dtypes[0])
-
-    return reprojected_data, profile
+    return WarpedVRT(second_src,
+                     crs=raster_src.crs,
+                     transform=raster_src.transform,
+                     width=raster_src.width,
+                     height=raster_src.height,
+                     resampling=resampling)
@@ -1,17 +1,29 @@
 import logging
+import warnings
 
 import numpy as np
+from rasterio.enums import MaskFlags
 from rasterio.features import shapes
-from rasterio.io import MemoryFile
 from rasterio.warp import calculate_default_transform
+from rasterio.windows import Window
+import shapely
 from shapely.geometry import shape
-from shapely.ops import unary_union
 
-def make_in_memory_raster(data, profile):
-    memfile = MemoryFile()
-    with memfile.open(**profile) as dataset:
-        dataset.write(data, 1)
-    return memfile.open()
+def iterate_raster_windows(height, width, tile_size):
+
+    # Yield square windows (smaller at the right and bottom edges) which
+    # cover the raster.
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield Window(col_off, row_off,
+                         min(tile_size, width - col_off),
+                         min(tile_size, height - row_off))
+
+def get_buffer_view(buffer, shape):
+
+    # Return a (contiguous) view of the start of a flat buffer, with the
+    # given 2D shape.
+    return buffer[: shape[0] * shape[1]].reshape(shape)
 
 def generate_raster_profile_from_crs(dst_crs, raster_src, raster_profile):
 
@@ -30,15 +42,23 @@ def generate_raster_profile_from_crs(dst_crs, raster_src, raster_profile):
 
     return transform, width, height, dst_profile
 
-def calculate_pixel_size_and_counts(profile, raster_data, verbose = True):
+def calculate_pixel_area_km2(transform):
+
+    pixel_width_metres = abs(transform.a)
+    pixel_height_metres = abs(transform.e)
+    pixel_area_km2 = (pixel_width_metres * pixel_height_metres) / 1.0E6
+
+    return pixel_area_km2
+
+def calculate_pixel_size_and_counts(profile, raster_valid, verbose = True):
 
     pixel_width_metres = abs(profile['transform'].a) 
     pixel_height_metres = abs(profile['transform'].e)
-    pixel_area_km2 = (pixel_width_metres * pixel_height_metres) / 1.0E6
+    pixel_area_km2 = calculate_pixel_area_km2(profile['transform'])
     #
-    n_pxls_total = raster_data.size
-    n_pxls_masked = np.ma.count_masked(raster_data)
-    n_pxls_unmasked = np.ma.count(raster_data)
+    n_pxls_total = raster_valid.size
+    n_pxls_unmasked = int(np.count_nonzero(raster_valid))
+    n_pxls_masked = n_pxls_total - n_pxls_unmasked
     #
     area_total_km2 = pixel_area_km2 * n_pxls_total
     area_masked_km2 = pixel_area_km2 * n_pxls_masked
@@ -72,24 +92,53 @@ def calculate_pixel_size_and_counts(profile, raster_data, verbose = True):
     
     return raster_info_dict
 
-def summarise_raster(src, data):
+def read_band_with_valid_mask(src, band):
+
+    # Read a band as a plain array, along with a boolean array which is
+    # True for valid (non-null) pixels. This matches the mask from
+    # src.read(band, masked=True), without building a masked array.
+    data = src.read(band)
+
+    # If the mask comes only from the nodata value of the file, it can be
+    # found by comparing with the nodata value. Otherwise, the mask is read
+    # from the file.
+    if all(flags == [MaskFlags.nodata] for flags in src.mask_flag_enums):
+        valid = get_valid_mask(data, src.nodata)
+    else:
+        valid = src.read_masks(band) > 0
+
+    return data, valid
+
+def get_valid_mask(data, nodata):
+
+    # Pixels are valid unless they are equal to the nodata value (which
+    # may be NaN, in which case it has to be checked separately).
+    if nodata is None:
+        return np.ones(data.shape, dtype=bool)
+    if np.isnan(nodata):
+        return ~np.isnan(data)
+    return np.not_equal(data, nodata)
+
+def summarise_raster(src, data, valid):
 
     # Basic metadata
     projection = src.crs
     dimensions = (src.height, src.width)
     bounds = src.bounds
 
-    # Null (masked) analysis
+    # Null analysis
     total_cells = data.size
-    null_cells = np.ma.count_masked(data)
+    null_cells = total_cells - int(np.count_nonzero(valid))
     null_fraction = null_cells / total_cells
 
     # Non-null stats
-    non_null_data = data.compressed()  # Unmask data to get only valid values
-    min_val = np.min(non_null_data)
-    max_val = np.max(non_null_data)
-    mean_val = np.mean(non_null_data)
-    median_val = np.median(non_null_data)
+    # The valid values are extracted once, and the statistics are
+    # calculated on that plain array.
+    non_null_data = data[valid]
+    min_val = non_null_data.min()
+    max_val = non_null_data.max()
+    mean_val = non_null_data.mean()
+    median_val = calculate_median_in_place(non_null_data)
 
     if null_fraction < 0.1:
         warnings.warn("Raster has less than 10% null values, check they were read correctly.")
@@ -112,23 +161,70 @@ def summarise_raster(src, data):
 
     return summary
 
-def get_non_null_region_of_raster_as_multipolygon(raster_data, transform):
+def calculate_median_in_place(values):
+
+    # Find the middle value(s) by selection (a partial sort, which is
+    # linear in the number of values) rather than a full sort. The array
+    # is partitioned in place, so it is reordered.
+    n_values = values.size
+    k = n_values // 2
+    if n_values % 2:
+        values.partition(k)
+        middle = values[k : k + 1]
+    else:
+        values.partition((k - 1, k))
+        middle = values[k - 1 : k + 1]
+
+    # The mean of the middle value(s) has the same type as np.median().
+    return middle.mean()
+
+def get_non_null_region_of_raster_as_multipolygon(valid_mask, transform, coarsen_factor = 1):
 
-    # Create a mask for non-null pixels
-    valid_mask = ~raster_data.mask
+    # valid_mask is a boolean array, True for the non-null pixels.
+
+    # Optionally, get a coarse outline (for uses which don't need the
+    # exact pixel boundary). Each block of coarsen_factor × coarsen_factor
+    # pixels becomes one pixel, which is valid if any pixel in the block is
+    # valid. This greatly reduces the number of vertices to trace.
+    if coarsen_factor > 1:
+        valid_mask, transform = coarsen_mask(valid_mask, transform,
+                                             coarsen_factor)
 
     # Extract polygons from valid raster area
     # valid_shapes  A list of pairs of (geometry_dict, masked).
     # valid_polys   A list of shapely polygons, the shapes of the valid
     #               regions of the raster.
-    valid_shapes = shapes(valid_mask.astype(np.uint8),
+    # The boolean mask is viewed as uint8 (the same bytes), rather than
+    # copied, to get the image for shapes().
+    valid_shapes = shapes(valid_mask.view(np.uint8),
                           mask=valid_mask,
                           transform=transform)
     # shapely.geometry.shape takes a geometry dictionary and returns
     # a shapely geometry, sucha as a polygon.
     valid_polys = [shape(geom) for geom, val in valid_shapes if val == 1]
 
-    # Combine valid raster polygons into one geometry
-    raster_geom = unary_union(valid_polys)
+    # Combine valid raster polygons into one geometry.
+    # The polygons from shapes() never overlap and share exact edges, so
+    # they form a polygonal coverage, and can be merged with a coverage
+    # union (which is much faster than a general overlay union).
+    raster_geom = shapely.coverage_union_all(valid_polys)
 
     return raster_geom
+
+def coarsen_mask(mask, transform, factor):
+
+    # Pad the mask to a multiple of the factor, then reduce each block
+    # with a logical OR.
+    n_rows, n_cols = mask.shape
+    n_rows_coarse = -(-n_rows // factor)
+    n_cols_coarse = -(-n_cols // factor)
+    padded = np.zeros((n_rows_coarse * factor, n_cols_coarse * factor),
+                      dtype=bool)
+    padded[:n_rows, :n_cols] = mask
+    mask_coarse = padded.reshape(n_rows_coarse, factor,
+                                 n_cols_coarse, factor).any(axis=(1, 3))
+
+    # Scale the transform to the coarse pixel size.
+    transform_coarse = transform * transform.scale(factor, factor)
+
+    return mask_coarse, transform_coarse
@@ -1,19 +1,46 @@
+import functools
+from itertools import chain
 import json
 import logging
 import os
+import re
 
-import geopandas as gpd
+import pyogrio
+# orjson (optional) is a much faster JSON encoder than the built-in one.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from interact_with_aws.aws_tools import (
         upload_file_to_aws)
 
-def get_unique_list_from_nested_attr(dict_, key):
+# Common mojibake patterns and their correct characters.
+MOJIBAKE_REPLACEMENTS = {
+    'Ã³': 'ó',  # RegiÃ³n → Región
+    'Ã¡': 'á',  # TarapacÃ¡ → Tarapacá
+    'Ã©': 'é',  # café → café
+    'Ã±': 'ñ',  # España → España
+    'Ãº': 'ú',  # Perú → Perú
+    'Ã­': 'í',  # México → México
+    'Ã ': 'à',  # là → là
+    'Ã¨': 'è',  # très → très
+    'Ã¬': 'ì',  # così → così
+    'Ã²': 'ò',  # però → però
+    'Ã¹': 'ù',  # più → più
+    'Ã§': 'ç',  # français → français
+    'Ã¼': 'ü',  # über → über
+    'Ã¶': 'ö',  # schön → schön
+    'Ã¤': 'ä',  # mädchen → mädchen
+}
+MOJIBAKE_PATTERN = re.compile('|'.join(
+                        re.escape(mojibake) for mojibake in MOJIBAKE_REPLACEMENTS))
 
-    combined = []
-    for val in dict_.values():
+def get_unique_list_from_nested_attr(dict_, key):
 
-        # Safely get list or empty list, and extend full list with it.
-        combined.extend(val.get(key, []))
+    # Safely get each list (or an empty tuple), and chain them together
+    # directly into a set, without building a combined list.
+    combined = chain.from_iterable(val.get(key, ()) for val in dict_.values())
 
     # Get sorted unique list.
     unique_sorted = sorted(set(combined))
@@ -52,12 +79,19 @@ def generate_admin_boundary_json_wrapper(results, dir_output, path_adm0,
     #    logging.info('The admin boundary information has changed, updating file {:}.'.format(path_admin_boundary_json))
     logging.info('Writing admin boundary info to {:}'.format(
         path_admin_boundary_json))
-    with open(path_admin_boundary_json, 'w', encoding='utf-8') as f:
-        json.dump(adm_dict, f,
-                  indent=4,
-                  ensure_ascii=False,
-                  #cls = custom_JSON_encoder,
-                  )
+    # Both encoders write equivalent JSON (same indent, UTF-8, not
+    # ASCII-escaped). orjson only supports an indent of 2, so the fallback
+    # uses 2 as well.
+    if orjson is not None:
+        with open(path_admin_boundary_json, 'wb') as f:
+            f.write(orjson.dumps(adm_dict, option = orjson.OPT_INDENT_2))
+    else:
+        with open(path_admin_boundary_json, 'w', encoding='utf-8') as f:
+            json.dump(adm_dict, f,
+                      indent=2,
+                      ensure_ascii=False,
+                      #cls = custom_JSON_encoder,
+                      )
 
     upload_file_to_aws(path_admin_boundary_json, overwrite = True)
 
@@ -65,48 +99,72 @@ def generate_admin_boundary_json_wrapper(results, dir_output, path_adm0,
 
 def generate_admin_boundary_json(path_adm0, path_adm1, adm0_list, adm1_list):
 
-    # Load the country outlines (admin-0 boundaries).
-    gdf_adm0 = gpd.read_file(path_adm0)
-    gdf_adm0.set_index('iso3', inplace = True)
-
-    # Load the admin-1 boundaries.
-    gdf_adm1 = gpd.read_file(path_adm1)
-    gdf_adm1.set_index('adm1_code', inplace = True)
+    # Load the country outlines (admin-0 boundaries), and select the
+    # countries in the list.
+    gdf_adm0 = load_admin_boundaries(path_adm0,
+                                     os.path.getmtime(path_adm0),
+                                     ('iso3', 'name', 'shapeType'))
+    gdf_adm0 = gdf_adm0.set_index('iso3').loc[adm0_list]
+
+    # Load the admin-1 boundaries, and select the zones in the list.
+    gdf_adm1 = load_admin_boundaries(path_adm1,
+                                     os.path.getmtime(path_adm1),
+                                     ('adm1_code', 'name', 'adm0_iso3'))
+    gdf_adm1 = gdf_adm1.set_index('adm1_code').loc[adm1_list]
+
+    # Get the bounding boxes of all the geometries at once.
+    # Each row is (minx, miny, maxx, maxy), i.e.
+    # [lon_min, lat_min, lon_max, lat_max].
+    bboxes_adm0 = gdf_adm0.geometry.bounds.to_numpy().tolist()
+    bboxes_adm1 = gdf_adm1.geometry.bounds.to_numpy().tolist()
     
     # Store information in dictionary.
     adm_dict= {}
     adm_dict['adm0'] = {}
     adm_dict['adm1'] = {}
     
-    for iso3 in adm0_list:
-        row = gdf_adm0.loc[iso3]
-        # Get bounding box from geometry
-        bounds = row.geometry.bounds  # returns (minx, miny, maxx, maxy)
-
-        if (row['shapeType'] != 'ADM0'):
+    # The keys are taken from the index of the selected rows (not from the
+    # input lists), so that a code which appears more than once in a layer
+    # cannot shift the names and bounding boxes onto the wrong zones.
+    for iso3, name, shape_type, bbox in zip(gdf_adm0.index,
+                                            gdf_adm0['name'].tolist(),
+                                            gdf_adm0['shapeType'].tolist(),
+                                            bboxes_adm0):
+
+        if (shape_type != 'ADM0'):
             is_disputed = 'yes'
         else:
             is_disputed = 'no'
         
         adm_dict['adm0'][iso3] = {
-            'name': fix_mojibake_encoding(row['name']),
-            'bbox': [bounds[0], bounds[1], bounds[2], bounds[3]],  # [lon_min, lat_min, lon_max, lat_max]
+            'name': fix_mojibake_encoding(name),
+            'bbox': bbox,
             'is_disputed' : is_disputed,
         }
 
-    for adm1_code in adm1_list:
-        row = gdf_adm1.loc[adm1_code]
-        # Get bounding box from geometry
-        bounds = row.geometry.bounds  # returns (minx, miny, maxx, maxy)
+    for adm1_code, name, adm0_iso3, bbox in zip(gdf_adm1.index,
+                                            gdf_adm1['name'].tolist(),
+                                            gdf_adm1['adm0_iso3'].tolist(),
+                                            bboxes_adm1):
         
         adm_dict['adm1'][adm1_code] = {
-            'name': fix_mojibake_encoding(row['name']),
-            'adm0_iso3': row['adm0_iso3'],
-            'bbox': [bounds[0], bounds[1], bounds[2], bounds[3]]  # [lon_min, lat_min, lon_max, lat_max]
+            'name': fix_mojibake_encoding(name),
+            'adm0_iso3': adm0_iso3,
+            'bbox': bbox,
         }
 
     return adm_dict
 
+@functools.lru_cache(maxsize = 4)
+def load_admin_boundaries(path, mtime, columns):
+
+    # Read only the requested columns (and the geometry). The result is
+    # cached, so repeated calls don't re-read the file. The modification
+    # time is part of the cache key, so the file is re-read if it changes.
+    # The cached frame is shared between calls, so it must not be modified
+    # in place.
+    return pyogrio.read_dataframe(path, columns = list(columns))
+
 def fix_mojibake(text):
     """
     Fix mojibake in a single string
@@ -117,32 +175,15 @@ def fix_mojibake(text):
     Returns:
         str: Fixed string with proper UTF-8 characters
     """
-    if not isinstance(text, str):
+    # All of the known patterns start with 'Ã', so strings without it can
+    # be returned unchanged.
+    if not isinstance(text, str) or ('Ã' not in text):
         return text
 
-    # Method 1: Direct replacement (fastest for known patterns)
-    replacements = {
-        'Ã³': 'ó',  # RegiÃ³n → Región
-        'Ã¡': 'á',  # TarapacÃ¡ → Tarapacá
-        'Ã©': 'é',  # café → café
-        'Ã±': 'ñ',  # España → España
-        'Ãº': 'ú',  # Perú → Perú
-        'Ã­': 'í',  # México → México
-        'Ã ': 'à',  # là → là
-        'Ã¨': 'è',  # très → très
-        'Ã¬': 'ì',  # così → così
-        'Ã²': 'ò',  # però → però
-        'Ã¹': 'ù',  # più → più
-        'Ã§': 'ç',  # français → français
-        'Ã¼': 'ü',  # über → über
-        'Ã¶': 'ö',  # schön → schön
-        'Ã¤': 'ä',  # mädchen → mädchen
-    }
-
-    for mojibake, correct in replacements.items():
-        text = text.replace(mojibake, correct)
-
-    return text
+    # Method 1: Direct replacement (fastest for known patterns), done in a
+    # single pass with a precompiled regular expression.
+    return MOJIBAKE_PATTERN.sub(
+            lambda match: MOJIBAKE_REPLACEMENTS[match.group(0)], text)
 
 def fix_mojibake_encoding(text):
     """
@@ -154,6 +195,10 @@ def fix_mojibake_encoding(text):
     Returns:
         str: Fixed string
     """
+    # Plain ASCII strings (most names) can't contain mojibake.
+    if not isinstance(text, str) or text.isascii():
+        return text
+
     try:
         # Try to encode as Latin-1 then decode as UTF-8
         return text.encode('latin-1').decode('utf-8')
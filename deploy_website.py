@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import shutil
@@ -10,6 +11,11 @@ from interact_with_aws.aws_tools import (clear_s3_directory,
 from utilities.use_command_line import run_cmd
 from utilities.handle_logging import set_up_logging
 
+# Pattern to match /assets/, ./assets/, or assets/ references
+# This will match href="/assets/..." and src="/assets/..." 
+# (the third group is the filename after "assets/").
+ASSET_URL_PATTERN = re.compile(r'(href|src)="(\.?/?assets/([^"]+))"')
+
 def deploy_website(aws_base_url="https://your-bucket.s3.amazonaws.com"):
     """
     Build and deploy website to AWS with updated asset URLs
@@ -47,8 +53,14 @@ def deploy_website(aws_base_url="https://your-bucket.s3.amazonaws.com"):
         if os.path.exists(dist_dest):
             shutil.rmtree(dist_dest)
         
-        # Copy the entire dist directory
-        shutil.copytree(dist_source, dist_dest)
+        # Copy the entire dist directory. The built files are not modified,
+        # so they are hard-linked rather than copied where possible. The
+        # HTML file is modified below, so it gets a real copy (otherwise
+        # the edit would also change the file in the build directory).
+        shutil.copytree(dist_source, dist_dest, copy_function = link_or_copy)
+        os.unlink(os.path.join(dist_dest, 'index.html'))
+        shutil.copy2(os.path.join(dist_source, 'index.html'),
+                     os.path.join(dist_dest, 'index.html'))
 
         gitkeep_path = Path(dist_dest) / ".gitkeep"
         gitkeep_path.touch()
@@ -57,31 +69,30 @@ def deploy_website(aws_base_url="https://your-bucket.s3.amazonaws.com"):
         print("Clearing existing files on S3...")
         clear_s3_directory('wildcru-wildmaps', 'website_dist/')
         
-        # Step 4: Upload files to AWS
-        print("Uploading files to AWS...")
-        
-        # Upload CSS file with appropriate headers
-        css_files = list(Path(dist_dest).glob('assets/*.css'))
-        for css_file in css_files:
-            upload_file_to_aws(str(css_file), headers={'Content-Type': 'text/css'}, overwrite = True)
-        
-        # Upload JS files with appropriate headers
-        js_files = list(Path(dist_dest).glob('assets/*.js'))
-        for js_file in js_files:
-            upload_file_to_aws(str(js_file), headers={'Content-Type': 'application/javascript'}, overwrite = True)
-        
-        # Upload HTML file with appropriate headers
-        html_file = os.path.join(dist_dest, 'index.html')
-        upload_file_to_aws(html_file, headers={'Content-Type': 'text/html'},
-                           overwrite = True)
-        
-        # Step 5: Modify index.html to point to AWS URLs
+        # Step 4: Modify index.html to point to AWS URLs (before uploading
+        # it, so it only has to be uploaded once)
         print("Updating asset URLs in index.html...")
+        html_file = os.path.join(dist_dest, 'index.html')
         update_html_asset_urls(html_file, aws_base_url)
+
+        # Step 5: Upload files to AWS
+        print("Uploading files to AWS...")
         
-        # Re-upload the modified HTML file
-        upload_file_to_aws(html_file, headers={'Content-Type': 'text/html'},
-                           overwrite = True)
+        # Upload the CSS, JS and HTML files (with appropriate headers).
+        # The uploads are network-bound, so they are done in parallel
+        # threads.
+        files_and_headers = \
+            [(str(css_file), {'Content-Type': 'text/css'})
+             for css_file in Path(dist_dest).glob('assets/*.css')] + \
+            [(str(js_file), {'Content-Type': 'application/javascript'})
+             for js_file in Path(dist_dest).glob('assets/*.js')] + \
+            [(html_file, {'Content-Type': 'text/html'})]
+        with ThreadPoolExecutor(max_workers = 16) as executor:
+            list(executor.map(
+                lambda file_and_headers: upload_file_to_aws(
+                    file_and_headers[0], headers = file_and_headers[1],
+                    overwrite = True),
+                files_and_headers))
         
         print("Deployment completed successfully!")
         
@@ -91,6 +102,17 @@ def deploy_website(aws_base_url="https://your-bucket.s3.amazonaws.com"):
         os.chdir(start_dir)
         raise
 
+def link_or_copy(src, dst):
+    """
+    Hard-link a file, falling back to a copy (e.g. across filesystems)
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+    return dst
+
 def update_html_asset_urls(html_file_path, aws_base_url="https://your-bucket.s3.amazonaws.com"):
     """
     Update the HTML file to point asset URLs to AWS
@@ -102,22 +124,16 @@ def update_html_asset_urls(html_file_path, aws_base_url="https://your-bucket.s3.
     with open(html_file_path, 'r', encoding='utf-8') as file:
         html_content = file.read()
     
-    # Pattern to match /assets/, ./assets/, or assets/ references
-    # This will match href="/assets/..." and src="/assets/..." 
-    asset_pattern = r'(href|src)="(\.?/?assets/[^"]+)"'
-    
     def replace_asset_url(match):
         attribute = match.group(1)  # 'href' or 'src'
-        old_path = match.group(2)   # the full path like "/assets/index-CGV6iwgK.js"
-        # Extract just the filename part after "assets/"
-        filename = old_path.split('assets/')[-1]
+        filename = match.group(3)   # the filename after "assets/"
         #new_url = f'{attribute}="{aws_base_url}/assets/{filename}"'
         new_url = f'{attribute}="{aws_base_url}/website_dist/assets/{filename}"'
-        print(f"Replacing: {match.group(0)} -> {new_url}")
+        logging.debug(f"Replacing: {match.group(0)} -> {new_url}")
         return new_url
     
     # Apply the replacement
-    updated_content = re.sub(asset_pattern, replace_asset_url, html_content)
+    updated_content = ASSET_URL_PATTERN.sub(replace_asset_url, html_content)
     
     # Write the updated content back to the file
     with open(html_file_path, 'w', encoding='utf-8') as file:
@@ -1,19 +1,101 @@
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                as_completed, wait)
+from contextlib import closing
+import gzip
+import hashlib
 import logging 
 import mimetypes
 import json
 import os
 from pathlib import Path
 import tempfile
+import threading
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from tqdm import tqdm
 
+from utilities.handle_cache import CACHE_DIR, write_file_atomically
+
 AWS_PROFILE_NAME = "WildMapsMaintainer"
 AWS_BUCKET = "wildcru-wildmaps"
-
-
-def download_file_from_aws(local_path, bucket = None, key = None, overwrite=False):
+# The S3 client keeps enough connections open for all of the upload
+# threads (the default is 10, and connections beyond that are closed and
+# re-opened for each request). Throttled requests are retried, with the
+# request rate adapted to avoid further throttling.
+S3_CLIENT_CONFIG = Config(
+        max_pool_connections = 64,
+        retries = {'max_attempts': 10, 'mode': 'adaptive'},
+        tcp_keepalive = True)
+# The boto3 sessions and S3 clients (created when first needed, and then
+# shared), for each AWS profile.
+AWS_SESSIONS = {}
+S3_CLIENTS = {}
+AWS_CACHE_LOCK = threading.RLock()
+# Number of batches of objects deleted at the same time.
+DELETE_MAX_WORKERS = 8
+# Number of tiles uploaded at the same time, and the maximum number
+# waiting to be uploaded.
+TILE_UPLOAD_MAX_WORKERS = 16
+TILE_UPLOAD_MAX_QUEUED = 4 * TILE_UPLOAD_MAX_WORKERS
+# Single large files (such as the input data files) are transferred in
+# parts, with up to 20 parts in parallel threads.
+TRANSFER_CONFIG = TransferConfig(
+        multipart_threshold = 8 * 1024 * 1024,
+        multipart_chunksize = 16 * 1024 * 1024,
+        max_concurrency = 20,
+        use_threads = True)
+# Each tile upload runs in the calling (worker) thread, as the tiles are
+# already uploaded in parallel. Only large files are split into parts,
+# and with large parts.
+TILE_TRANSFER_CONFIG = TransferConfig(
+        multipart_threshold = 64 * 1024 * 1024,
+        multipart_chunksize = 32 * 1024 * 1024,
+        use_threads = False)
+# The first two bytes of a gzip file.
+GZIP_MAGIC_NUMBER = b'\x1f\x8b'
+# The types of tile file which are uploaded, and the extra arguments
+# (headers) for their uploads. Vector tiles are served gzip-encoded. These
+# are shared between uploads (boto3 copies them rather than modifying them).
+TILE_UPLOAD_EXTRA_ARGS = {
+    '.json': {'ContentType': 'application/json'},
+    '.png': {'ContentType': 'image/png'},
+    '.pbf': {'ContentType': 'application/x-protobuf',
+             'ContentEncoding': 'gzip'},
+}
+
+
+def get_aws_session(profile_name = AWS_PROFILE_NAME):
+    """
+    Get a boto3 session for the given profile. Creating a session reads
+    the AWS configuration and credentials files, so it is only done once
+    per profile.
+    """
+    # The lock stops threads from creating sessions at the same time (the
+    # first uploads are often started from several threads at once, and
+    # creating a session is not thread-safe).
+    with AWS_CACHE_LOCK:
+        if profile_name not in AWS_SESSIONS:
+            AWS_SESSIONS[profile_name] = boto3.Session(
+                                            profile_name=profile_name)
+        return AWS_SESSIONS[profile_name]
+
+def get_s3_client(profile_name = AWS_PROFILE_NAME):
+    """
+    Get an S3 client for the given profile. Creating a client is slow, and
+    reusing it also reuses its open connections, so it is only done once
+    per profile. The client is thread-safe, so it can be shared.
+    """
+    with AWS_CACHE_LOCK:
+        if profile_name not in S3_CLIENTS:
+            S3_CLIENTS[profile_name] = get_aws_session(profile_name).client(
+                                            's3', config = S3_CLIENT_CONFIG)
+        return S3_CLIENTS[profile_name]
+
+def download_file_from_aws(local_path, bucket = None, key = None, overwrite=False,
+                           transfer_config = TRANSFER_CONFIG):
     """
     Download a file from S3 to local path.
     
@@ -22,6 +104,7 @@ def download_file_from_aws(local_path, bucket = None, key = None, overwrite=Fals
         bucket (str): S3 bucket name
         key (str): S3 object key
         overwrite (bool): Whether to overwrite existing local file
+        transfer_config (TransferConfig): Settings for the (multipart) download
     """
 
     if bucket is None:
@@ -42,13 +125,13 @@ def download_file_from_aws(local_path, bucket = None, key = None, overwrite=Fals
         os.makedirs(local_dir, exist_ok=True)
         logging.info(f"Created directory: {local_dir}")
     
-    # Initialize S3 client with profile
-    session = boto3.Session(profile_name=AWS_PROFILE_NAME)
-    s3 = session.client('s3')
+    # Get the (shared) S3 client
+    s3 = get_s3_client()
     
     try:
         logging.info(f"Downloading s3://{bucket}/{key} to {local_path}")
-        s3.download_file(Bucket=bucket, Key=key, Filename=local_path)
+        s3.download_file(Bucket=bucket, Key=key, Filename=local_path,
+                         Config=transfer_config)
         logging.info("Download complete.")
         return True
     except ClientError as e:
@@ -234,7 +317,7 @@ def get_default_headers_for_file(file_path):
 
     return headers
 
-def upload_file_to_aws(local_path, bucket=None, key=None, overwrite=False, headers=None, auto_headers=False):
+def upload_file_to_aws(local_path, bucket=None, key=None, overwrite=False, headers=None, auto_headers=False, skip_unchanged=False):
     """
     Upload a file from local path to S3.
 
@@ -245,6 +328,7 @@ def upload_file_to_aws(local_path, bucket=None, key=None, overwrite=False, heade
         overwrite (bool): Whether to overwrite existing S3 object
         headers (dict): Optional headers to set on the S3 object (e.g., {'Content-Type': 'text/css'})
         auto_headers (bool): Whether to automatically add headers based on file extension
+        skip_unchanged (bool): Whether to skip the upload if the S3 object has the same contents (compared by MD5 hash)
     """
     if bucket is None:
         bucket = AWS_BUCKET
@@ -256,9 +340,8 @@ def upload_file_to_aws(local_path, bucket=None, key=None, overwrite=False, heade
         logging.error(f"**Local file does not exist: {local_path}**")
         return False
 
-    # Initialize S3 client with profile
-    session = boto3.Session(profile_name=AWS_PROFILE_NAME)
-    s3 = session.client('s3')
+    # Get the (shared) S3 client
+    s3 = get_s3_client()
 
     # Check if S3 object already exists (if overwrite is False)
     if not overwrite:
@@ -275,6 +358,23 @@ def upload_file_to_aws(local_path, bucket=None, key=None, overwrite=False, heade
                 logging.error(f"Error checking S3 object: {e}")
                 return False
 
+    # Check if the S3 object already has the same contents (if
+    # skip_unchanged is True). The MD5 hash of the local file is stored
+    # in the object metadata on upload, because the ETag is only the MD5
+    # hash for files uploaded in a single part.
+    if skip_unchanged:
+        local_md5 = get_cached_file_md5(local_path)
+        try:
+            response = s3.head_object(Bucket=bucket, Key=key)
+            if local_md5 in [response['ETag'].strip('"'),
+                             response.get('Metadata', {}).get('local-md5')]:
+                logging.info(f"S3 object is already up to date: s3://{bucket}/{key}")
+                return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != '404':
+                logging.error(f"Error checking S3 object: {e}")
+                return False
+
     try:
         logging.info(f"Uploading {local_path} to s3://{bucket}/{key}")
 
@@ -312,11 +412,16 @@ def upload_file_to_aws(local_path, bucket=None, key=None, overwrite=False, heade
             if metadata:
                 extra_args['Metadata'] = metadata
 
+        if skip_unchanged:
+            extra_args.setdefault('Metadata', {})['local-md5'] = local_md5
+
         # Upload with extra arguments if provided
         if extra_args:
-            s3.upload_file(Filename=local_path, Bucket=bucket, Key=key, ExtraArgs=extra_args)
+            s3.upload_file(Filename=local_path, Bucket=bucket, Key=key, ExtraArgs=extra_args,
+                           Config=TRANSFER_CONFIG)
         else:
-            s3.upload_file(Filename=local_path, Bucket=bucket, Key=key)
+            s3.upload_file(Filename=local_path, Bucket=bucket, Key=key,
+                           Config=TRANSFER_CONFIG)
 
         logging.info("Upload complete.")
         return True
@@ -342,9 +447,8 @@ def check_if_file_exists_on_aws(key, bucket=None):
     if bucket is None:
         bucket = AWS_BUCKET
     
-    # Initialize S3 client with profile
-    session = boto3.Session(profile_name=AWS_PROFILE_NAME)
-    s3 = session.client('s3')
+    # Get the (shared) S3 client
+    s3 = get_s3_client()
     
     try:
         logging.info(f"Checking if file exists: s3://{bucket}/{key}")
@@ -362,39 +466,47 @@ def check_if_file_exists_on_aws(key, bucket=None):
         logging.error(f"Unexpected error: {e}")
         return False
 
-def download_and_parse_aws(path, parse_func):
+def download_and_parse_aws(path, parse_func = None, parse_stream_func = None,
+                           bucket = None):
+
+    if bucket is None:
+        bucket = AWS_BUCKET
+
+    # If the parser can read from a file-like object, the body of the S3
+    # object is passed to it directly (as a stream), without writing it to
+    # disk and reading it back.
+    if parse_stream_func is not None:
+
+        s3 = get_s3_client()
+        logging.info(f"Reading s3://{bucket}/{path}")
+        response = s3.get_object(Bucket=bucket, Key=path)
+        with closing(response['Body']) as body:
+            return parse_stream_func(body)
+
+    # Otherwise, download to a temporary file for the parser. The temporary
+    # directory (and the file) is removed automatically, even if there is
+    # an error.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, os.path.basename(path))
 
-    # Create a temporary file
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        tmp_path = tmp_file.name
-    
-    try:
         # Download the file
-        download_file_from_aws(tmp_path, key = path,
+        download_file_from_aws(tmp_path, bucket = bucket, key = path,
                                overwrite = True)
-        
+
         # Process the file
-        result = parse_func(tmp_path)
-        
-        return result
-        
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-    
-    return None
+        return parse_func(tmp_path)
 
-def upload_tiles_to_aws(dir_path_local, key, overwrite, bucket = None):
+def upload_tiles_to_aws(dir_path_local, key, overwrite, bucket = None,
+                        profile_name = AWS_PROFILE_NAME):
     # !!! Don’t need key.
 
     if bucket is None:
 
         bucket = AWS_BUCKET
 
-    #session = boto3.Session(profile_name="habitat-maintainer")
-    session = boto3.Session(profile_name=AWS_PROFILE_NAME)
-    s3 = session.client('s3')
+    # Get the (shared) S3 client for the profile (e.g. "habitat-maintainer"
+    # for the older habitat-web-map bucket).
+    s3 = get_s3_client(profile_name)
 
     #try:
     #    response = s3.list_buckets()
@@ -417,16 +529,27 @@ def upload_tiles_to_aws(dir_path_local, key, overwrite, bucket = None):
     skip_upload = False
 
     if overwrite != 'yes':
+        # Compare the MD5 hash of the local manifest with the ETag of the
+        # remote copy (which is the MD5 hash of its contents, if it was
+        # uploaded in a single part), so the remote copy doesn't need to be
+        # downloaded.
         try:
-            remote_manifest_obj = s3.get_object(Bucket=bucket, Key=remote_manifest_key)
-            remote_manifest = remote_manifest_obj['Body'].read().decode('utf-8')
-            with open(local_manifest_path, 'r') as f:
-                local_manifest = f.read()
-            if remote_manifest.strip() == local_manifest.strip():
+            remote_manifest_etag = s3.head_object(Bucket=bucket,
+                                        Key=remote_manifest_key)['ETag'].strip('"')
+            if '-' in remote_manifest_etag:
+                # The remote copy was uploaded in multiple parts, so its
+                # ETag is not the MD5 hash of its contents, and the contents
+                # have to be compared directly.
+                manifest_matches = check_if_file_matches_s3_object(
+                        s3, bucket, remote_manifest_key, local_manifest_path)
+            else:
+                manifest_matches = (remote_manifest_etag ==
+                                    compute_file_md5(local_manifest_path))
+            if manifest_matches:
                 logging.info("Manifest matches remote copy. Skipping upload.")
                 skip_upload = True
         except ClientError as e:
-            if e.response['Error']['Code'] != 'NoSuchKey':
+            if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
                 raise
             logging.info("Remote manifest not found. Proceeding with upload.")
 
@@ -436,84 +559,234 @@ def upload_tiles_to_aws(dir_path_local, key, overwrite, bucket = None):
         else:
             return
 
-    # Walk through all files in dir_path_local
-    file_paths = []
-    for root, _, files in os.walk(dir_path_local):
-        for file in files:
-            full_path = os.path.join(root, file)
-            relative_path = os.path.relpath(full_path, dir_path_local)
-            if not (full_path.endswith('.png') or
-                    full_path.endswith('.json') or
-                    full_path.endswith('.pbf')
-                    ):
-                continue
-            s3_key = f"{key}/{relative_path.replace(os.sep, '/')}"
-            file_paths.append((full_path, s3_key))
+    # In partial sync mode, only upload files which are not already on
+    # S3. The existing keys are found with a paginated listing (up to 1000
+    # keys per request), rather than checking each file separately. The
+    # listing runs in the background while the local files are found.
+    with ThreadPoolExecutor(max_workers = 1) as listing_executor:
 
+        if partial_sync_mode:
+            remote_keys_future = listing_executor.submit(
+                    list_keys_with_prefix, s3, bucket, f"{key}/")
+
+        # Find all of the tile files in dir_path_local (and its
+        # subdirectories), and their upload arguments. The paths found all
+        # start with dir_path_local, so the relative path is found by
+        # removing that prefix (rather than with os.path.relpath(), which
+        # is much slower). The path separators only need to be changed on
+        # systems where they aren't already '/'.
+        prefix_length = len(os.path.join(dir_path_local, ''))
+        convert_separators = (os.sep != '/')
+        file_paths = []
+        for full_path, extension in iterate_files_with_extensions(
+                                        dir_path_local, TILE_UPLOAD_EXTRA_ARGS):
+            relative_path = full_path[prefix_length:]
+            if convert_separators:
+                relative_path = relative_path.replace(os.sep, '/')
+            file_paths.append((full_path, f"{key}/{relative_path}",
+                               TILE_UPLOAD_EXTRA_ARGS[extension]))
+
+        if partial_sync_mode:
+            remote_keys = remote_keys_future.result()
+            file_paths = [file_path for file_path in file_paths
+                          if file_path[1] not in remote_keys]
+
+    # Start the largest files first, so they aren't left running on their
+    # own at the end while the other threads are idle.
+    file_paths.sort(key = lambda file_path: os.path.getsize(file_path[0]),
+                    reverse = True)
+
+    # Upload the files in parallel threads (each upload is a separate
+    # network request, so most of the time is spent waiting). The S3
+    # client is shared, as boto3 clients are thread-safe.
     logging.info(f"Uploading {len(file_paths)} files to s3://{bucket}/{key}/")
-    for full_path, s3_key in tqdm(file_paths, desc="Uploading tiles", unit="file"):
+    # Only a limited number of uploads are queued at a time, so that
+    # there isn't a pending task for every tile, and so that an error
+    # stops any more uploads from being started.
+    with ThreadPoolExecutor(max_workers = TILE_UPLOAD_MAX_WORKERS) as executor, \
+            tqdm(total = len(file_paths), desc="Uploading tiles",
+                 unit="file") as progress_bar:
+
+        futures = set()
+        for full_path, s3_key, extra_args in file_paths:
         
-        # Set the content type.
-        if full_path.endswith('.json'):
-            content_type = 'application/json'
-        elif full_path.endswith('.png'):
-            content_type = 'image/png'
-        elif full_path.endswith('.pbf'):
-            content_type = 'application/x-protobuf'
-        else: 
-            content_type = None
-
-        if content_type is not None:
-            extra_args  = {'ContentType': content_type}
-            if content_type == 'application/x-protobuf':
-                extra_args['ContentEncoding'] = 'gzip'
-        else:
-            extra_args = None
-        
-        if not partial_sync_mode:
+            # Wait for an upload to finish (raising any errors), if the
+            # queue is full.
+            if len(futures) >= TILE_UPLOAD_MAX_QUEUED:
+                done, futures = wait(futures, return_when = FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                progress_bar.update(len(done))
+
+            futures.add(executor.submit(upload_tile_to_aws, s3,
+                                        full_path, bucket, s3_key,
+                                        extra_args))
+
+        # Wait for the remaining uploads to finish (raising any errors).
+        for future in as_completed(futures):
+            future.result()
+            progress_bar.update(1)
 
-            s3.upload_file(Filename=full_path, Bucket=bucket, Key=s3_key,
-                           ExtraArgs = extra_args,
-                           )
-        else:
+    logging.info("Upload complete.")
+    return
 
-            try:
-                s3.head_object(Bucket=bucket, Key=s3_key)
-                #logging.info("File already exists!")
-            except ClientError as e:
-                if e.response['Error']['Code'] == '404':
-                    # File doesn't exist, safe to upload
-                    s3.upload_file(Filename=full_path, Bucket=bucket, Key=s3_key, ExtraArgs=extra_args)
+def list_keys_with_prefix(s3, bucket, prefix):
+
+    # Get the keys of all the objects with the prefix, using a paginated
+    # listing (up to 1000 keys per request).
+    paginator = s3.get_paginator('list_objects_v2')
+    return set(obj['Key']
+               for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+               for obj in page.get('Contents', []))
+
+def upload_tile_to_aws(s3, full_path, bucket, s3_key, extra_args):
+
+    # Tiles served with gzip encoding (vector tiles) are compressed here if
+    # they aren't already (checked using the gzip magic number). This runs
+    # in the upload threads, so the compression of one tile overlaps with
+    # the uploads of others.
+    if extra_args.get('ContentEncoding') == 'gzip':
+        with open(full_path, 'rb') as in_id:
+            data = in_id.read()
+        if not data.startswith(GZIP_MAGIC_NUMBER):
+            data = gzip.compress(data, compresslevel = 6, mtime = 0)
+        # The compressed tile is already in memory (and small), so it is
+        # sent with a single PutObject request, without the overhead of a
+        # managed transfer.
+        s3.put_object(Bucket=bucket, Key=s3_key, Body=data, **extra_args)
+    else:
+        s3.upload_file(Filename=full_path, Bucket=bucket, Key=s3_key,
+                       ExtraArgs = extra_args,
+                       Config = TILE_TRANSFER_CONFIG)
 
-    logging.info("Upload complete.")
     return
 
-def clear_s3_directory(bucket, prefix):
+def iterate_files_with_extensions(dir_path, extensions):
+
+    # Yield the path and extension of each file in the directory (and its
+    # subdirectories) whose extension is in the given collection.
+    # os.scandir() gets the file types from the directory listing, so
+    # (unlike os.walk) the files don't need to be checked separately. The
+    # subdirectories are kept in a stack (rather than searched by
+    # recursion, which would nest a generator for each level). As with
+    # os.walk, symbolic links to directories are not followed.
+    dir_paths = [dir_path]
+    while dir_paths:
+        with os.scandir(dir_paths.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks = False):
+                    dir_paths.append(entry.path)
+                else:
+                    extension = os.path.splitext(entry.name)[1]
+                    if extension in extensions:
+                        yield entry.path, extension
+
+def compute_file_md5(file_path):
     """
-    Delete all objects in S3 bucket with the given prefix
+    Compute the MD5 hash of a file (as a hex string, the same format as the
+    ETag of an S3 object uploaded in a single part).
+    The file is hashed in chunks by hashlib (without holding the whole file
+    in memory).
     """
-    session = boto3.Session(profile_name=AWS_PROFILE_NAME)
-    s3 = session.client('s3')
+    with open(file_path, 'rb') as f:
+        return hashlib.file_digest(f, 'md5').hexdigest()
 
-    try:
-        # List all objects with the prefix
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
+def check_if_file_matches_s3_object(s3, bucket, key, file_path,
+                                    chunk_size = 65536):
+    """
+    Check if a local file has the same contents as an object on S3.
+    Both are hashed in chunks as they are read (rather than being read
+    into memory and compared), so memory use doesn't depend on the size.
+    """
+    response = s3.get_object(Bucket=bucket, Key=key)
+    # (The body is closed explicitly, as using it as a context manager
+    # gives the underlying raw stream.)
+    with closing(response['Body']) as body:
+
+        # Files of different sizes can't match.
+        if response['ContentLength'] != os.path.getsize(file_path):
+            return False
 
-        if 'Contents' in response:
-            # Prepare list of objects to delete
-            objects_to_delete = [{'Key': obj['Key']} for obj in response['Contents']]
+        remote_hash = hashlib.sha256()
+        for chunk in body.iter_chunks(chunk_size):
+            remote_hash.update(chunk)
 
-            print(f"Deleting {len(objects_to_delete)} existing files from s3://{bucket}/{prefix}")
+    local_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            local_hash.update(chunk)
 
-            # Delete objects in batches (S3 allows up to 1000 objects per delete request)
-            for i in range(0, len(objects_to_delete), 1000):
-                batch = objects_to_delete[i:i+1000]
-                s3.delete_objects(
-                    Bucket=bucket,
-                    Delete={'Objects': batch}
-                )
+    return remote_hash.digest() == local_hash.digest()
+
+def get_cached_file_md5(file_path):
+    """
+    Get the MD5 hash of a file, using a copy cached on disk by a previous
+    run if the file has not changed (so large files are not hashed again).
+    """
+    # There is one cache file for each local file (keyed on its absolute
+    # path only, so it is overwritten when the file changes, and old hashes
+    # don't build up). It also records the modification time and size of
+    # the file, so the hash is not used if the file has changed.
+    file_stat = os.stat(file_path)
+    cache_key = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()
+    path_cache = os.path.join(CACHE_DIR, 'md5_{:}.txt'.format(cache_key))
+    file_version = '{:d} {:d}'.format(file_stat.st_mtime_ns, file_stat.st_size)
+    if os.path.exists(path_cache):
+        with open(path_cache, 'r') as in_id:
+            cached_version, _, cached_md5 = in_id.read().rpartition(' ')
+        if cached_version == file_version:
+            return cached_md5
+
+    file_md5 = compute_file_md5(file_path)
+
+    # Save to the disk cache.
+    write_file_atomically(path_cache,
+                          '{:} {:}'.format(file_version, file_md5))
+
+    return file_md5
 
-            print("Existing files deleted successfully")
+def clear_s3_directory(bucket, prefix):
+    """
+    Delete all objects in S3 bucket with the given prefix
+    """
+    s3 = get_s3_client()
+
+    try:
+        # Delete all objects with the prefix. Each page of the listing (up
+        # to 1000 objects) is deleted with a single DeleteObjects request.
+        # The requests are sent from parallel threads, so the deletions
+        # overlap with each other and with listing the next pages.
+        paginator = s3.get_paginator('list_objects_v2')
+        with ThreadPoolExecutor(max_workers = DELETE_MAX_WORKERS) as executor:
+            futures = []
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                objects = [{'Key': obj['Key']}
+                           for obj in page.get('Contents', [])]
+                if objects:
+                    futures.append((len(objects), executor.submit(
+                        s3.delete_objects, Bucket=bucket,
+                        Delete={'Objects': objects, 'Quiet': True})))
+
+            # In quiet mode, only the objects which couldn't be deleted
+            # are listed in the response.
+            n_deleted = 0
+            errors = []
+            for n_objects, future in futures:
+                page_errors = future.result().get('Errors', [])
+                n_deleted += n_objects - len(page_errors)
+                errors.extend(page_errors)
+
+        # Stop if any objects could not be deleted (otherwise they would
+        # be left under the prefix, mixed with the new files).
+        if errors:
+            for error in errors:
+                print(f"Could not delete s3://{bucket}/{error.get('Key')}: "
+                      f"{error.get('Code')} {error.get('Message')}")
+            raise RuntimeError(f"Could not delete {len(errors)} files from "
+                               f"s3://{bucket}/{prefix}")
+
+        if n_deleted > 0:
+            print(f"Deleted {n_deleted} existing files from s3://{bucket}/{prefix}")
         else:
             print(f"No existing files found in s3://{bucket}/{prefix}")
 
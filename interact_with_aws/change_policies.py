@@ -1,10 +1,10 @@
-import boto3
 import json
 import sys
 from botocore.exceptions import ClientError, NoCredentialsError
 
 from interact_with_aws.aws_tools import (AWS_PROFILE_NAME as PROFILE_NAME,
-                                         AWS_BUCKET as BUCKET_NAME)
+                                         AWS_BUCKET as BUCKET_NAME,
+                                         get_s3_client)
 from utilities.handle_logging import set_up_logging
 
 def update_bucket_policy(bucket_name, policy_file_path, profile_name):
@@ -15,8 +15,7 @@ def update_bucket_policy(bucket_name, policy_file_path, profile_name):
     # Validate JSON
     json.loads(policy_json)
     
-    session = boto3.Session(profile_name=profile_name)
-    s3 = session.client('s3')
+    s3 = get_s3_client(profile_name)
     s3.put_bucket_policy(Bucket=bucket_name, Policy=policy_json)
     print(f"✅ Bucket policy updated for {bucket_name}")
 
@@ -25,8 +24,7 @@ def update_cors_policy(bucket_name, cors_file_path, profile_name):
     with open(cors_file_path, 'r') as f:
         cors_config = json.load(f)
     
-    session = boto3.Session(profile_name=profile_name)
-    s3 = session.client('s3')
+    s3 = get_s3_client(profile_name)
     s3.put_bucket_cors(
         Bucket=bucket_name,
         CORSConfiguration=cors_config
@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
 import argparse
 
-from interact_with_aws.aws_tools import download_file_from_aws
+from boto3.s3.transfer import TransferConfig
+
+from interact_with_aws.aws_tools import (S3_CLIENT_CONFIG, TRANSFER_CONFIG,
+                                         download_file_from_aws)
 from utilities.handle_logging import set_up_logging
 
 def main():
@@ -22,9 +26,23 @@ def main():
         'data_inputs/vector/admin_boundaries/geoBoundaries/geoBoundariesCGAZ_ADM1_repaired_twice.gpkg',
         ]
     
-    for file_ in files_to_get:
-        success = download_file_from_aws(file_,
-                                         overwrite=args.overwrite)
+    # Download the files at the same time, in parallel threads (each large
+    # file is also downloaded in parts in parallel, and writing to disk
+    # overlaps with receiving the other files). The files share one S3
+    # client, so the parts in parallel for each file are limited, so that
+    # the total fits within the client's connection pool.
+    transfer_config = TransferConfig(
+            multipart_threshold = TRANSFER_CONFIG.multipart_threshold,
+            multipart_chunksize = TRANSFER_CONFIG.multipart_chunksize,
+            max_concurrency = max(S3_CLIENT_CONFIG.max_pool_connections
+                                  // len(files_to_get), 1),
+            use_threads = True)
+    with ThreadPoolExecutor(max_workers = len(files_to_get)) as executor:
+        success = list(executor.map(
+            lambda file_: download_file_from_aws(file_,
+                                    overwrite=args.overwrite,
+                                    transfer_config=transfer_config),
+            files_to_get))
 
 if __name__ == "__main__":
     main()
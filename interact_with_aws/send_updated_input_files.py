@@ -38,10 +38,11 @@ def main():
     paths.append(os.path.join(dir_data_inputs, 'website_assets', 'splash_page_animation.mp4'))
     paths.append(os.path.join(dir_data_inputs, 'website_assets', 'wildmaps_logo.png'))
     
+    # Files which haven't changed since they were last sent are skipped.
     for path_ in paths:
         
         upload_file_to_aws(path_, overwrite = True,
-                           auto_headers = True)
+                           auto_headers = True, skip_unchanged = True)
 
     return
 
@@ -3,7 +3,6 @@ import os
 
 import pandas as pd
 
-#from handle_aws import aws_bucket, upload_to_aws
 from interact_with_aws.aws_tools import (
         AWS_BUCKET as aws_bucket, upload_tiles_to_aws)
 from prepare_raster_for_hosting import extract_band_and_generate_tiles
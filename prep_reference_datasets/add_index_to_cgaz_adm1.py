@@ -1,7 +1,9 @@
 import argparse
+import logging
 
-import fiona
 import geopandas as gpd
+import numpy as np
+import pyogrio
 
 def parse_args():
     parser = argparse.ArgumentParser(description = 
@@ -29,40 +31,39 @@ def main():
 
     # Load the GeoPackage (assumes there is only one layer).
     #layer_name = gpd.io.file.fiona.listlayers(path_adm1)[0]
-    layer_name = fiona.listlayers(path_adm1)[0]
+    layer_name = pyogrio.list_layers(path_adm1)[0][0]
     gdf = gpd.read_file(path_adm1, layer=layer_name)
 
-    # Group by 'adm0_iso' and sort by 'name' within each group
-    groups = gdf.groupby('adm0_iso3', sort=False)
-    
-    # Create a list to track the new adm1_code values
-    adm1_codes = []
-    
-    # Process each group
-    for adm0_iso3, group in groups:
-        sorted_group = group.sort_values('name')
-        logging.info(f"{adm0_iso3}: {len(sorted_group)} items")
-        # Generate padded index for each item in group
-        for i in range(len(sorted_group)):
-            code = f"{adm0_iso3}_{str(i+1).zfill(3)}"
-            adm1_codes.append(code)
-    
-    # Assign new column in the correct order
-    # Since the groupby breaks the original order, we must reprocess carefully
-    gdf_sorted = (
-        gdf.groupby('adm0_iso3', group_keys=False)
-           .apply(lambda x: x.sort_values('name'))
-           .reset_index(drop=True)
-    )
-    gdf_sorted['adm1_code'] = [
-        f"{adm0_iso3}_{str(i+1).zfill(3)}"
-        for adm0_iso3, group in gdf_sorted.groupby('adm0_iso3')
-        for i in range(len(group))
-    ]
+    # Sort by country, then alphabetically by name within each country.
+    gdf_sorted = gdf.sort_values(['adm0_iso3', 'name'], kind='stable'
+                                 ).reset_index(drop=True)
+
+    # Report the number of zones in each country.
+    for adm0_iso3, n_zones in gdf_sorted.groupby('adm0_iso3').size().items():
+        logging.info(f"{adm0_iso3}: {n_zones} items")
+
+    # Generate the padded index for each zone (its position within its
+    # country) and build the codes, e.g. 'USA_001'.
+    # The strings are joined with vectorised NumPy string operations.
+    idx = gdf_sorted.groupby('adm0_iso3', sort=False).cumcount() + 1
+    iso_array = gdf_sorted['adm0_iso3'].to_numpy().astype(str)
+    idx_padded = np.char.zfill(idx.to_numpy().astype(str), 3)
+    gdf_sorted['adm1_code'] = np.char.add(np.char.add(iso_array, '_'),
+                                          idx_padded)
     
-    # Overwrite the original file
+    # Overwrite the original file.
+    # pyogrio writes all the features in a single transaction, and the
+    # GPKG driver fills the spatial index after the bulk insert. The
+    # SQLite settings skip the journal and disk syncs, which are not
+    # needed because the file is being rewritten from scratch.
     logging.info('Re-writing {:}'.format(path_adm1))
-    gdf_sorted.to_file(path_adm1, layer=layer_name, driver='GPKG')
+    pyogrio.set_gdal_config_options({
+        'OGR_SQLITE_SYNCHRONOUS' : 'OFF',
+        'OGR_SQLITE_JOURNAL' : 'MEMORY',
+        'OGR_SQLITE_CACHE' : 512, # MB.
+        })
+    pyogrio.write_dataframe(gdf_sorted, path_adm1, layer=layer_name,
+                            driver='GPKG')
 
     return
 
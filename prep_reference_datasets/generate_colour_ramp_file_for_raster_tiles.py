@@ -31,34 +31,22 @@ def generate_palette(colormap_name: str, num_stops: int, vmin: float, vmax: floa
     else:
         values = np.geomspace(vmin, vmax, num_stops)
 
-    pad = 253.0 / (num_stops - 1)
-     
+    # Sample the colormap at all of the stops in a single call, and
+    # convert to 8-bit RGB (truncating, as int() does).
+    i_norm = np.arange(num_stops) / (num_stops - 1)
+    rgb = (255 * cmap(i_norm)[:, :3]).astype(int)
+
+    # The first and last colours are also used for values just outside the
+    # range (padding by 1).
+    values = values.tolist()
+    rgb = rgb.tolist()
+    values = [values[0] - 1] + values + [values[-1] + 1]
+    rgb = [rgb[0]] + rgb + [rgb[-1]]
+    lines = [f"{val} {r} {g} {b}\n" for val, (r, g, b) in zip(values, rgb)]
+
     with open(output_path, "w") as f:
         f.write("nv 0 0 0 0\n")  # NoData entry as transparent black
-        for i, val in enumerate(values):
-            i_norm = i / (len(values) - 1)
-            rgba = cmap(i_norm)
-            #val_norm = (val - vmin) / (vmax - vmin) 
-            #rgba = cmap(val_norm)
-
-            r, g, b = [int(255 * c) for c in rgba[:3]]
-            #print(values[i], r, g, b)
-
-            i_frac =  1.0 + 253 * (i / (num_stops - 1))
-
-            if (i == 0):
-                #val_i = val - pad
-                #f.write(f"{val_i:.6f} {r} {g} {b}\n")
-
-                f.write(f"{val - 1} {r} {g} {b}\n")
-
-            #f.write(f"{val:.6f} {r} {g} {b}\n")
-            f.write(f"{val} {r} {g} {b}\n")
-
-            if (i == num_stops - 1):
-                #val_i = val + pad
-                #f.write(f"{val_i:.6f} {r} {g} {b}\n")
-                f.write(f"{val + 1} {r} {g} {b}\n")
+        f.writelines(lines)
 
     logging.info(f"Palette file written to {output_path}")
 
@@ -7,16 +7,16 @@ handling dateline crossings properly for use with MapLibre GL JS.
 """
 
 import argparse
-import csv
 import os
 import sys
 from pathlib import Path
 
 try:
     import geopandas as gpd
+    import numpy as np
     import pandas as pd
-    from shapely.geometry import box, Polygon
-    from shapely.ops import unary_union
+    import shapely
+    from shapely.geometry import Polygon
 except ImportError as e:
     logging.info(f"Error: Required package not found: {e}")
     logging.info("Please install required packages:")
@@ -35,58 +35,49 @@ def compute_smart_bbox(geometry):
     Compute bounding box handling dateline crossings.
     Returns (lon_min, lat_min, lon_max, lat_max) suitable for MapLibre GL JS.
     """
-    if geometry.is_empty:
+    # Get the bounds (found by GEOS without extracting the coordinates).
+    # These are NaN if the geometry is empty (or missing), so no separate
+    # check of the geometry type or emptiness is needed.
+    lon_min, lat_min, lon_max, lat_max = shapely.bounds(geometry).tolist()
+    if np.isnan(lon_min):
         return None, None, None, None
     
-    # Get all coordinates from the geometry
-    if hasattr(geometry, 'geoms'):  # MultiPolygon or GeometryCollection
-        coords = []
-        for geom in geometry.geoms:
-            if hasattr(geom, 'exterior'):  # Polygon
-                coords.extend(list(geom.exterior.coords))
-                for interior in geom.interiors:
-                    coords.extend(list(interior.coords))
-            elif hasattr(geom, 'coords'):  # LineString or Point
-                coords.extend(list(geom.coords))
-    elif hasattr(geometry, 'exterior'):  # Single Polygon
-        coords = list(geometry.exterior.coords)
-        for interior in geometry.interiors:
-            coords.extend(list(interior.coords))
-    elif hasattr(geometry, 'coords'):  # LineString or Point
-        coords = list(geometry.coords)
-    else:
-        # Fallback to bounds
-        bounds = geometry.bounds
-        return bounds[0], bounds[1], bounds[2], bounds[3]
+    # If the naive span is not more than 180°, there is no dateline
+    # crossing to handle, so the bounds are the answer.
+    if lon_max - lon_min <= 180:
+        return clamp_bbox(lon_min, lat_min, lon_max, lat_max)
+    
+    # Get all coordinates from the geometry (of any type, including the
+    # interior rings of polygons) as an (N, 2) array, in a single call.
+    coords = shapely.get_coordinates(geometry)
     
-    if not coords:
+    if coords.size == 0:
         return None, None, None, None
     
-    lons = [coord[0] for coord in coords]
-    lats = [coord[1] for coord in coords]
+    lons = coords[:, 0]
+    lats = coords[:, 1]
     
-    lat_min, lat_max = min(lats), max(lats)
+    lat_min, lat_max = lats.min(), lats.max()
     
     # Smart dateline crossing detection and handling
-    lon_min, lon_max = min(lons), max(lons)
+    lon_min, lon_max = lons.min(), lons.max()
     
     # If naive span > 180°, we might have a dateline crossing
     if lon_max - lon_min > 180:
         # Test if the geometry actually crosses the dateline or if it's just spread wide
         # Method: compute the "wrap-around" bounding box and see which makes more sense
         
-        # Sort longitudes to analyze distribution
-        sorted_lons = sorted(lons)
-        
-        # Find the largest gap between consecutive longitudes
-        max_gap = 0
-        gap_start_idx = 0
+        # Sort longitudes to analyze distribution (all of the counts and
+        # extremes below are then found from the sorted array by indexing
+        # or binary search, rather than further passes over the array)
+        sorted_lons = np.sort(lons)
+        n_lons = sorted_lons.size
         
-        for i in range(len(sorted_lons) - 1):
-            gap = sorted_lons[i + 1] - sorted_lons[i]
-            if gap > max_gap:
-                max_gap = gap
-                gap_start_idx = i
+        # Find the largest gap between consecutive longitudes (the first
+        # one, if there is a tie)
+        gaps = np.diff(sorted_lons)
+        gap_start_idx = int(gaps.argmax())
+        max_gap = gaps[gap_start_idx]
         
         # Also check the wrap-around gap (from largest to smallest + 360)
         wrap_gap = (sorted_lons[0] + 360) - sorted_lons[-1]
@@ -107,50 +98,49 @@ def compute_smart_bbox(geometry):
                     # This means we're spanning across the dateline
                     # Keep the original bounds but be aware this crosses dateline
                     logging.info(f"    Warning: Geometry appears to cross dateline, bbox may be wide")
-                    lon_min, lon_max = min(lons), max(lons)
+                    lon_min, lon_max = sorted_lons[0], sorted_lons[-1]
             else:
                 # The wrap-around gap is largest, so use normal bounds
-                lon_min, lon_max = min(lons), max(lons)
+                lon_min, lon_max = sorted_lons[0], sorted_lons[-1]
         
         # Additional heuristic: if we have points on both sides of ±150°, 
         # it's likely a Pacific region crossing the dateline
-        far_west = [lon for lon in lons if lon > 150]  # Western Pacific
-        far_east = [lon for lon in lons if lon < -150]  # Eastern Pacific
+        has_far_west = sorted_lons[-1] > 150  # Western Pacific
+        has_far_east = sorted_lons[0] < -150  # Eastern Pacific
         
-        if far_west and far_east:
+        if has_far_west and has_far_east:
             # Definitely crosses dateline in Pacific
             # For MapLibre GL JS, we need to decide how to represent this
             # Option 1: Use the side with more points
             # Option 2: Use the side that makes geographic sense
             
-            west_count = len(far_west)
-            east_count = len(far_east)
-            
-            # Count points in middle regions too
-            middle_west = [lon for lon in lons if 0 <= lon <= 150]
-            middle_east = [lon for lon in lons if -150 <= lon < 0]
-            
-            total_west = len(far_west) + len(middle_west)
-            total_east = len(far_east) + len(middle_east)
+            # Count points on each side (the far regions plus the middle
+            # regions, i.e. 0 <= lon <= 150 and -150 <= lon < 0). The
+            # negative longitudes are the first total_east sorted values.
+            total_east = int(np.searchsorted(sorted_lons, 0, side='left'))
+            total_west = n_lons - total_east
             
             if total_west > total_east:
                 # More points on western side (positive longitudes)
-                western_lons = [lon for lon in lons if lon >= 0]
-                if western_lons:
-                    lon_min, lon_max = min(western_lons), max(western_lons)
+                if total_west:
+                    lon_min, lon_max = sorted_lons[total_east], sorted_lons[-1]
             else:
                 # More points on eastern side (negative longitudes)  
-                eastern_lons = [lon for lon in lons if lon < 0]
-                if eastern_lons:
-                    lon_min, lon_max = min(eastern_lons), max(eastern_lons)
+                if total_east:
+                    lon_min, lon_max = sorted_lons[0], sorted_lons[total_east - 1]
     
+    return clamp_bbox(lon_min, lat_min, lon_max, lat_max)
+
+
+def clamp_bbox(lon_min, lat_min, lon_max, lat_max):
+    """Clamp a bounding box to valid longitudes and latitudes"""
     # Ensure longitude bounds are within valid range
     lon_min = max(-180, min(180, lon_min))
     lon_max = max(-180, min(180, lon_max))
     lat_min = max(-90, min(90, lat_min))
     lat_max = max(-90, min(90, lat_max))
     
-    return lon_min, lat_min, lon_max, lat_max
+    return float(lon_min), float(lat_min), float(lon_max), float(lat_max)
 
 
 def process_gpkg_to_csv(gpkg_path, csv_path):
@@ -176,18 +166,42 @@ def process_gpkg_to_csv(gpkg_path, csv_path):
         
         results = []
         
-        # Group by SUBREGION and compute bounding boxes
-        for subregion in gdf['SUBREGION'].unique():
-            if pd.isna(subregion):
-                continue
-                
-            region_geom = gdf[gdf['SUBREGION'] == subregion].geometry
-            
-            # Union all geometries for this subregion
-            union_geom = unary_union(region_geom.values)
+        # Group by SUBREGION and combine the bounds of the features in each
+        # group (in order of first appearance, skipping missing values)
+        bounds = gdf.geometry.bounds
+        bounds['SUBREGION'] = gdf['SUBREGION']
+        region_bounds = bounds.groupby('SUBREGION', sort=False).agg(
+                lon_min=('minx', 'min'), lat_min=('miny', 'min'),
+                lon_max=('maxx', 'max'), lat_max=('maxy', 'max'))
+        
+        # Union the geometries of the subregions which might cross the
+        # dateline (those spanning more than 180°), all together in one
+        # dissolve (a single geometry is used as it is)
+        is_wide = (region_bounds['lon_max'] - region_bounds['lon_min']) > 180
+        wide_geoms = gdf[gdf['SUBREGION'].isin(region_bounds.index[is_wide])
+                         ][['SUBREGION', 'geometry']].dissolve(
+                                 by='SUBREGION').geometry
+        
+        # Clamp all of the combined bounds to the valid range at once
+        # (NaN bounds, from empty geometries, stay NaN)
+        clamped_bounds = np.clip(region_bounds.to_numpy(dtype=float),
+                                 [-180, -90, -180, -90], [180, 90, 180, 90])
+        
+        # Compute bounding boxes
+        for subregion, wide, (lon_min, lat_min, lon_max, lat_max) in zip(
+                region_bounds.index, is_wide, clamped_bounds.tolist()):
             
-            # Compute smart bounding box
-            lon_min, lat_min, lon_max, lat_max = compute_smart_bbox(union_geom)
+            if np.isnan(lon_min):
+                # All of the geometries are empty
+                lon_min, lat_min, lon_max, lat_max = None, None, None, None
+            elif not wide:
+                # No dateline crossing, so the combined (clamped) bounds can
+                # be used directly (without a union)
+                pass
+            else:
+                # Compute smart bounding box
+                lon_min, lat_min, lon_max, lat_max = compute_smart_bbox(
+                        wide_geoms[subregion])
             
             if lon_min is not None:  # Valid bbox computed
                 results.append({
@@ -203,10 +217,8 @@ def process_gpkg_to_csv(gpkg_path, csv_path):
         
         # Write results to CSV
         if results:
-            with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=['name', 'lon_min', 'lon_max', 'lat_min', 'lat_max'])
-                writer.writeheader()
-                writer.writerows(results)
+            pd.DataFrame(results, columns=['name', 'lon_min', 'lon_max', 'lat_min', 'lat_max']
+                         ).to_csv(csv_path, index=False, encoding='utf-8', lineterminator='\r\n')
             
             logging.info(f"\nBounding boxes written to: {csv_path}")
             logging.info(f"Processed {len(results)} regions")
@@ -233,16 +245,12 @@ def generate_preview_gpkg(csv_path):
         if missing_cols:
             raise ValueError(f"Missing required columns: {missing_cols}")
         
-        # Create geometries from bounding boxes
-        geometries = []
-        for _, row in df.iterrows():
-            try:
-                # Create rectangle from bounding box
-                bbox_geom = box(row['lon_min'], row['lat_min'], row['lon_max'], row['lat_max'])
-                geometries.append(bbox_geom)
-            except Exception as e:
-                logging.info(f"Warning: Could not create geometry for {row['name']}: {e}")
-                geometries.append(None)
+        # Create geometries (rectangles) from all of the bounding boxes in
+        # a single vectorised call
+        geometries = shapely.box(df['lon_min'].to_numpy(dtype=float),
+                                 df['lat_min'].to_numpy(dtype=float),
+                                 df['lon_max'].to_numpy(dtype=float),
+                                 df['lat_max'].to_numpy(dtype=float))
         
         # Create GeoDataFrame
         gdf = gpd.GeoDataFrame(df, geometry=geometries, crs='EPSG:4326')
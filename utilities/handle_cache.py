@@ -0,0 +1,17 @@
+import os
+
+# Directory for files cached between runs (such as the dissolved protected
+# areas and the MD5 hashes of local files).
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'wildmaps')
+
+def write_file_atomically(path, data, mode = 'w'):
+
+    # Write to a temporary file first, and then move it into place, so
+    # that an interrupted write does not leave a corrupt file.
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    path_tmp = path + '.tmp'
+    with open(path_tmp, mode) as out_id:
+        out_id.write(data)
+    os.replace(path_tmp, path)
+
+    return
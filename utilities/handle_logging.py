@@ -1,6 +1,9 @@
+import atexit
 import os
 from datetime import datetime
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 import sys
 
 #class MultilineFormatter(logging.Formatter):
@@ -25,17 +28,39 @@ def set_up_logging(dir_output):
     
     # File handler
     file_handler = logging.FileHandler(path_log)
+    file_handler.setLevel(logging.INFO)
     #file_handler.setFormatter(formatter)
     
     # Console handler
     console_handler = logging.StreamHandler(sys.stdout)
     #console_handler.setFormatter(formatter)
+
+    formatter = logging.Formatter('%(message)s')
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+
+    # The file and console output is done by a background thread, which
+    # takes log records from a queue. So logging calls only have to put
+    # the record on the queue, instead of waiting for the writes.
+    log_queue = queue.SimpleQueue()
+    queue_listener = QueueListener(log_queue, file_handler, console_handler,
+                                   respect_handler_level=True)
+    queue_listener.start()
+
+    # Make sure the queue is emptied (and the files closed) at exit.
+    atexit.register(queue_listener.stop)
     
+    # The log format only uses the message, so skip collecting the thread,
+    # process and multiprocessing details for every record.
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
     # Configure root logger
     logging.basicConfig(
         level=logging.INFO,
         format='%(message)s',
-        handlers=[file_handler, console_handler]
+        handlers=[QueueHandler(log_queue)]
     )
 
     return